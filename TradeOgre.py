@@ -12,7 +12,7 @@ class API(object):
     on each query.
 
     """
-    def __init__(self, key=None, secret=None):
+    def __init__(self, key=None, secret=None, timeout=None):
         """ Create an object with authentication information.
 
         :param key: (optional) key identifier for queries to the API
@@ -21,11 +21,15 @@ class API(object):
         :param secret: (optional) actual private key used to sign messages
         :type secret: str
 
+        :param timeout: (optional) seconds to wait for a response from TradeOgre
+        :type timeout: float
+
         :returns: None
 
         """
         self.key = key
         self.secret = secret
+        self.timeout = timeout
         self.uri = 'https://tradeogre.com/api/v1'
         self.response = None
         return
@@ -52,7 +56,7 @@ class API(object):
         :returns: :py:meth:`requests.Response.json`-deserialised Python object
 
         """
-        self.response = requests.get(self.uri + '/markets').json()
+        self.response = requests.get(self.uri + '/markets', timeout=self.timeout).json()
         return self.response
 
     def orders(self, market):
@@ -64,7 +68,7 @@ class API(object):
         :returns: :py:meth:`requests.Response.json`-deserialised Python object
 
         """
-        self.response = requests.get(self.uri + '/orders/' + market).json()
+        self.response = requests.get(self.uri + '/orders/' + market, timeout=self.timeout).json()
         return self.response
 
     def ticker(self, market):
@@ -78,7 +82,7 @@ class API(object):
         :returns: :py:meth:`requests.Response.json`-deserialised Python object
 
         """
-        self.response = requests.get(self.uri + '/ticker/' + market).json()
+        self.response = requests.get(self.uri + '/ticker/' + market, timeout=self.timeout).json()
         return self.response
 
     def history(self, market):
@@ -91,7 +95,7 @@ class API(object):
         :returns: :py:meth:`requests.Response.json`-deserialised Python object
 
         """
-        self.response = requests.get(self.uri + '/history/' + market).json()
+        self.response = requests.get(self.uri + '/history/' + market, timeout=self.timeout).json()
         return self.response
 
     def balance(self, currency, key=None, secret=None):
@@ -0,0 +1,288 @@
+import time
+import random
+import logging
+import argparse
+import threading
+import itertools
+
+from collections import Counter, OrderedDict, deque
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+from replay import synthetic_updates, message_update, GROUP_ID, FIRST_USER
+
+# Number of incoming messages to remember to measure time until the bot replied
+MAX_PENDING_REPLIES = 100000
+# Seconds between status reports
+REPORT_SEC = 10
+
+# Command line options
+options = None
+# Updates that were not confirmed by the bot yet (via 'offset' of 'getUpdates')
+updates = deque()
+updates_cond = threading.Condition()
+update_ids = itertools.count(1)
+# IDs of messages sent by the bot
+message_ids = itertools.count(1)
+# Time when incoming message was queued per chat and message ID
+pending_replies = OrderedDict()
+# Requests per method, time until replies and recent messages per chat (to emulate chat limits)
+stats = Counter()
+reply_times = list()
+chat_sends = dict()
+stats_lock = threading.Lock()
+
+app = Flask(__name__)
+
+
+# Telegram chat object for given ID. Positive IDs are private chats
+def chat_dict(chat_id):
+    if isinstance(chat_id, int) and chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+    if isinstance(chat_id, int):
+        return {"id": chat_id, "type": "supergroup", "title": "Load test"}
+
+    # Username of a public chat like '@Stellite_TESTING'
+    return {"id": GROUP_ID, "type": "supergroup", "title": "Load test", "username": str(chat_id).lstrip("@")}
+
+
+# Parameters are sent as strings by the bot
+def chat_id_param(params):
+    chat_id = str(params.get("chat_id", GROUP_ID))
+    return int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id
+
+
+# Put update into queue for 'getUpdates'
+def push_update(update):
+    message = update["message"]
+    message["date"] = int(time.time())
+
+    with updates_cond:
+        update["update_id"] = message["message_id"] = next(update_ids)
+        updates.append(update)
+        updates_cond.notify_all()
+
+    with stats_lock:
+        stats["updates"] += 1
+        pending_replies[(message["chat"]["id"], message["message_id"])] = time.time()
+
+        if len(pending_replies) > MAX_PENDING_REPLIES:
+            pending_replies.popitem(last=False)
+
+
+# Long polling like Telegram. Updates before 'offset' are confirmed and removed
+def get_updates(params):
+    offset = int(params.get("offset") or 0)
+    limit = int(params.get("limit") or 100)
+    deadline = time.time() + float(params.get("timeout") or 0)
+
+    with updates_cond:
+        while updates and updates[0]["update_id"] < offset:
+            updates.popleft()
+
+        while not updates and time.time() < deadline:
+            updates_cond.wait(deadline - time.time())
+
+        return list(itertools.islice(updates, limit))
+
+
+# Answer for all 'send...' methods. Replies to queued messages are timed
+def send_message(params):
+    chat_id = chat_id_param(params)
+    reply_to = params.get("reply_to_message_id")
+
+    if reply_to:
+        with stats_lock:
+            queued = pending_replies.pop((chat_id, int(reply_to)), None)
+            if queued:
+                reply_times.append(time.time() - queued)
+
+    return {"message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": chat_dict(chat_id),
+            "text": params.get("text") or params.get("caption") or ""}
+
+
+# Like 'send_message' with the sizes of the uploaded photo
+def send_photo(params):
+    message = send_message(params)
+    message["photo"] = [{"file_id": f"photo{message['message_id']}", "width": 800, "height": 600}]
+    return message
+
+
+# Every chat exists
+def get_chat(params):
+    return chat_dict(chat_id_param(params))
+
+
+# Only one admin per chat
+def get_chat_administrators(params):
+    return [{"user": {"id": options.admin, "is_bot": False, "first_name": "admin"}, "status": "creator"}]
+
+
+# The bot itself
+def get_me(params):
+    return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "FakeStelliteBot"}
+
+
+# Methods that only need to succeed
+def success(params):
+    return True
+
+
+METHODS = {
+    "getMe": get_me,
+    "getUpdates": get_updates,
+    "deleteWebhook": success,
+    "sendMessage": send_message,
+    "sendPhoto": send_photo,
+    "sendVideo": send_message,
+    "sendDocument": send_message,
+    "getChat": get_chat,
+    "getChatAdministrators": get_chat_administrators,
+    "kickChatMember": success,
+    "restrictChatMember": success,
+    "deleteMessage": success
+}
+
+
+# Too many messages sent to this chat in the last minute? Returns seconds to wait
+def chat_limited(chat_id):
+    now = time.time()
+
+    with stats_lock:
+        sends = chat_sends.setdefault(chat_id, deque())
+
+        while sends and now - sends[0] > 60:
+            sends.popleft()
+
+        if len(sends) >= options.chat_limit:
+            return int(60 - (now - sends[0])) + 1
+
+        sends.append(now)
+        return 0
+
+
+# All Bot API methods with simulated latency and rate limits
+@app.route("/bot<token>/<method>", methods=["GET", "POST"])
+def api(token, method):
+    params = request.get_json(silent=True) or request.form.to_dict()
+
+    with stats_lock:
+        stats[method] += 1
+
+    if method not in METHODS:
+        return jsonify(ok=False, error_code=404, description="Not Found: method not implemented"), 404
+
+    if method != "getUpdates":
+        time.sleep((options.latency + random.uniform(0, options.jitter)) / 1000)
+
+        retry_after = 0
+        if random.random() < options.rate_429:
+            retry_after = options.retry_after
+        elif options.chat_limit and method.startswith("send"):
+            retry_after = chat_limited(chat_id_param(params))
+
+        if retry_after:
+            with stats_lock:
+                stats["429"] += 1
+
+            return jsonify(ok=False,
+                           error_code=429,
+                           description=f"Too Many Requests: retry after {retry_after}",
+                           parameters={"retry_after": retry_after}), 429
+
+    return jsonify(ok=True, result=METHODS[method](params))
+
+
+# Send synthetic updates at given rate. Optionally starts with a storm of joins
+def generate_load():
+    if options.join_storm:
+        for number in range(options.join_storm):
+            member = {"id": FIRST_USER + options.users + number, "is_bot": False, "first_name": "new"}
+            push_update(message_update(0, FIRST_USER, GROUP_ID, new_members=[member]))
+
+    if not options.rate:
+        return
+
+    load = synthetic_updates(int(options.rate * options.duration), options.users, options.seed)
+
+    start = time.time()
+    for number, update in enumerate(load):
+        wait = start + number / options.rate - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        push_update(update)
+
+
+# Print requests per method, pending updates and time until the bot replied
+def report():
+    with stats_lock:
+        counts = dict(stats)
+        times = sorted(reply_times)
+
+    with updates_cond:
+        pending = len(updates)
+
+    line = f"{time.strftime('%H:%M:%S')} pending updates: {pending}, "
+    line += ", ".join(f"{method}: {count}" for method, count in sorted(counts.items()))
+
+    if times:
+        p50 = times[len(times) // 2]
+        p99 = times[min(int(len(times) * 0.99), len(times) - 1)]
+        line += f" | replies: {len(times)}, p50 {p50 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms"
+
+    print(line, flush=True)
+
+
+def main():
+    global options
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API with load generator")
+    parser.add_argument("--port", type=int, default=8081, help="port to listen on")
+    parser.add_argument("--latency", type=float, default=20, help="latency of every request in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="random extra latency up to this many ms")
+    parser.add_argument("--rate-429", type=float, default=0, help="share of requests that get a 429 answer")
+    parser.add_argument("--retry-after", type=int, default=3, help="'retry_after' of injected 429 answers")
+    parser.add_argument("--chat-limit", type=int, default=0, help="max messages per chat and minute (0 = no limit)")
+    parser.add_argument("--rate", type=float, default=0, help="incoming messages per second (0 = no load)")
+    parser.add_argument("--users", type=int, default=200, help="number of simulated users")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to generate load")
+    parser.add_argument("--join-storm", type=int, default=0, help="number of joins to send at once before the load")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for generated messages")
+    parser.add_argument("--admin", type=int, default=FIRST_USER, help="user ID returned as chat admin")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # Werkzeug logs every request otherwise
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", options.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"Bot API on http://127.0.0.1:{options.port}/bot - set 'bot_api_url' in config.json to this", flush=True)
+
+    load = threading.Thread(target=generate_load, daemon=True)
+    load.start()
+
+    try:
+        while True:
+            time.sleep(REPORT_SEC)
+
+            # Stop once load is done and the bot caught up
+            with updates_cond:
+                caught_up = not updates
+
+            if (options.rate or options.join_storm) and not load.is_alive() and caught_up:
+                break
+
+            report()
+    except KeyboardInterrupt:
+        pass
+
+    report()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
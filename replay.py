@@ -0,0 +1,317 @@
+import time
+import json
+import os
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import itertools
+
+import stellite_bot as sb
+
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from telegram import Bot, Update
+from telegram.ext import Updater
+from telegram.utils.request import Request
+
+# Chat ID of simulated group
+GROUP_ID = -1001000000001
+# First user ID of simulated users
+FIRST_USER = 100000
+# Share of synthetic updates per kind (rest are text messages)
+SHARE_JOIN = 0.08
+SHARE_COMMAND = 0.12
+SHARE_POLL = 0.10
+# Commands used in synthetic updates and chat where they are sent
+COMMANDS = [("/help", "group"), ("/wiki", "group"), ("/wiki cryptonote", "group"),
+            ("/wiki nothing", "group"), ("/cmc", "private"), ("/price", "private")]
+# Number of allocation sites to report
+TOP_ALLOCATIONS = 10
+
+
+# Bot API stand-in. Records every call and answers with minimal valid results
+class RecordingRequest(Request):
+    def __init__(self):
+        super().__init__(con_pool_size=8)
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    def get(self, url, timeout=None):
+        return self.post(url, dict(), timeout)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        self.calls[method] += 1
+
+        chat_id = data.get("chat_id", GROUP_ID)
+        chat = {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "supergroup"}
+
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Replay", "username": "ReplayBot"}
+        if method == "getChat":
+            # Groups have a pinned message that welcome messages link to
+            if chat["type"] != "private":
+                chat["pinned_message"] = {"message_id": 1, "date": 0, "chat": dict(chat)}
+            return chat
+        if method == "getChatAdministrators":
+            return [{"user": {"id": FIRST_USER, "is_bot": False, "first_name": "admin"}, "status": "creator"}]
+        if method.startswith("send") or method.startswith("edit"):
+            message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat}
+            if method == "sendPhoto":
+                message["photo"] = [{"file_id": f"photo{message['message_id']}", "width": 800, "height": 600}]
+            return message
+
+        return True
+
+
+# Build message update in Telegram JSON format
+def message_update(update_id, user_id, chat_id, text=None, new_members=None):
+    if chat_id > 0:
+        chat = {"id": chat_id, "type": "private", "first_name": f"user{user_id}"}
+    else:
+        chat = {"id": chat_id, "type": "supergroup", "title": "Replay"}
+
+    message = {"message_id": update_id,
+               "date": 0,
+               "chat": chat,
+               "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if new_members is not None:
+        message["new_chat_members"] = new_members
+
+    return {"update_id": update_id, "message": message}
+
+
+# Generate a mix of text messages, joins, commands and poll conversations
+def synthetic_updates(count, users, seed):
+    rnd = random.Random(seed)
+    update_ids = itertools.count(1)
+    new_users = itertools.count(FIRST_USER + users)
+    updates = list()
+
+    while len(updates) < count:
+        user_id = FIRST_USER + rnd.randrange(users)
+        kind = rnd.random()
+
+        if kind < SHARE_JOIN:
+            members = [{"id": next(new_users), "is_bot": False, "first_name": "new"} for _ in range(rnd.randint(1, 3))]
+            updates.append(message_update(next(update_ids), user_id, GROUP_ID, new_members=members))
+        elif kind < SHARE_JOIN + SHARE_COMMAND:
+            command, where = rnd.choice(COMMANDS)
+            chat_id = user_id if where == "private" else GROUP_ID
+            updates.append(message_update(next(update_ids), user_id, chat_id, command))
+        elif kind < SHARE_JOIN + SHARE_COMMAND + SHARE_POLL:
+            updates.append(message_update(next(update_ids), user_id, user_id, "/poll"))
+            updates.append(message_update(next(update_ids), user_id, user_id, rnd.choice(["yes", "no"])))
+        else:
+            text = rnd.choice(["Hello everyone", "When moon?", "gm", "Check https://stellite.cash",
+                               "What is the price today?", f"Message {rnd.randrange(1000)}"])
+            updates.append(message_update(next(update_ids), user_id, GROUP_ID, text))
+
+    return updates[:count]
+
+
+# Generate joins of one new user each, like during a raid
+def join_storm(count):
+    updates = list()
+
+    for number in range(count):
+        member = {"id": FIRST_USER + number + 1, "is_bot": False, "first_name": "new"}
+        updates.append(message_update(number + 1, member["id"], GROUP_ID, new_members=[member]))
+
+    return updates
+
+
+# Time flood detection per message, without the rest of the handlers. Every user sends
+# as many different messages as allowed, so nobody gets muted
+def bench_flood(count):
+    per_user = sb.config["flood_max_msg"]
+    updates = [Update.de_json(message_update(number + 1, FIRST_USER + 1 + number // per_user, GROUP_ID,
+                                             f"Message {number}"), sb.updater.bot) for number in range(count)]
+    cfg = sb.chat_cfg(updates[0].message.chat)
+    results = dict()
+
+    def run(label, func):
+        sb.flood_users.clear()
+        start = time.perf_counter()
+        for update in updates:
+            func(update.message)
+        results[label] = (time.perf_counter() - start) / count
+
+    run("track_activity", lambda message: sb.track_activity(cfg, message.chat_id, message.from_user.id,
+                                                             message.text.strip().lower(), 0, 0))
+    run("check_flood", lambda message: sb.check_flood(sb.updater.bot, SimpleNamespace(message=message)))
+
+    print(f"Flood detection for {count} messages from {len(sb.flood_users)} users")
+    for label, seconds in results.items():
+        print(f"{label:<30}{seconds * 1e6:>9.2f} us per message")
+
+
+# Read updates from a JSON list (e.g. 'result' of 'getUpdates') or one update per line
+def load_updates(path):
+    with open(path) as file:
+        content = file.read().strip()
+
+    if content.startswith("["):
+        return json.loads(content)
+
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+# Set up the real handlers with a recording bot. Config and state are copies in a temporary folder
+def init_replay(work_dir):
+    shutil.copy(sb.CFG_FILE, os.path.join(work_dir, sb.CFG_FILE))
+    sb.CFG_FILE = os.path.join(work_dir, sb.CFG_FILE)
+    sb.STATE_FILE = os.path.join(work_dir, sb.STATE_FILE)
+
+    sb.read_cfg()
+    sb.config["adm_list"] = [FIRST_USER]
+    sb.config["dev_user_id"] = FIRST_USER
+    sb.write_cfg()
+
+    request = RecordingRequest()
+
+    sb.updater = Updater(bot=Bot("123456:replay", request=request))
+    sb.dispatcher = sb.updater.dispatcher
+    sb.job_queue = sb.updater.job_queue
+
+    sb.init_executor()
+    sb.init_price_sources()
+    sb.price_sources = [sb.FakePriceSource("Replay", {"BTC": (0.00000123, 10.0)})]
+    sb.init_state()
+    sb.add_handlers()
+
+    # Active poll so that poll conversations have something to answer
+    sb.create_poll(sb.poll_chat(), "Replay poll", ["yes", "no"], "")
+
+    # Welcome messages are sent by a job
+    sb.job_queue.start()
+
+    return request
+
+
+# Percentile of sorted list
+def percentile(values, share):
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+# Print latency percentiles in milliseconds per label
+def print_latencies(title, durations):
+    print(f"\n{title:<30}{'calls':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)")
+
+    for label, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        print(f"{label:<30}{len(values):>8}" +
+              "".join(f"{value * 1000:>9.3f}" for value in
+                      (percentile(values, 0.5), percentile(values, 0.9), percentile(values, 0.99), values[-1])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Telegram updates through the bot's handlers")
+    parser.add_argument("file", nargs="?", help="recorded updates (JSON list or one update per line)")
+    parser.add_argument("--synthetic", type=int, default=5000, help="number of synthetic updates if no file is given")
+    parser.add_argument("--users", type=int, default=200, help="number of users in synthetic updates")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for synthetic updates")
+    parser.add_argument("--join-storm", type=int, default=0, help="replay this many single joins instead")
+    parser.add_argument("--save", help="save synthetic updates to this file and exit")
+    parser.add_argument("--flood-bench", type=int, default=0, help="only time flood detection for this many messages")
+    parser.add_argument("--alloc", action="store_true", help="trace memory allocations (slows down replay)")
+    args = parser.parse_args()
+
+    if args.file:
+        updates = load_updates(args.file)
+    elif args.join_storm:
+        updates = join_storm(args.join_storm)
+    else:
+        updates = synthetic_updates(args.synthetic, args.users, args.seed)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            file.write("\n".join(json.dumps(update) for update in updates) + "\n")
+        return
+
+    logging.basicConfig(level=logging.WARNING)
+
+    # Raw durations from the bot's own instrumentation
+    durations = {"stellite_handler_seconds": defaultdict(list), "stellite_slow_handler_seconds": defaultdict(list)}
+
+    def observe(name, labels, seconds, error=False):
+        if name in durations:
+            durations[name][labels["handler"]].append(seconds)
+
+    sb.observe = observe
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        request = init_replay(work_dir)
+
+        if args.flood_bench:
+            bench_flood(args.flood_bench)
+            sb.job_queue.stop()
+            sb.state_db.close()
+            return
+
+        # Updates older than the start of the bot would be treated as replayed after a restart
+        date = int(time.time()) + 1
+        for update in updates:
+            for key in ("message", "edited_message", "channel_post"):
+                if key in update:
+                    update[key]["date"] = date
+
+        # Parsing is done by the updater thread in the bot, so it isn't part of the measurement
+        parsed = [Update.de_json(update, sb.updater.bot) for update in updates]
+        while time.time() < date:
+            time.sleep(0.05)
+
+        if args.alloc:
+            tracemalloc.start(10)
+            before = tracemalloc.take_snapshot()
+
+        start = time.perf_counter()
+        for update in parsed:
+            sb.dispatcher.process_update(update)
+        dispatched = time.perf_counter() - start
+
+        # Wait for commands that run on the pool for slow commands
+        sb.slow_executor.shutdown(wait=True)
+        finished = time.perf_counter() - start
+
+        # Wait for welcome messages of joins. Not part of the measurement since they are delayed on purpose
+        while sb.job_queue.jobs():
+            time.sleep(0.05)
+
+        sb.job_queue.stop()
+
+        if args.alloc:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        sb.state_db.close()
+
+    print(f"Replayed {len(parsed)} updates")
+    print(f"Handlers: {dispatched:.3f} s ({len(parsed) / dispatched:.0f} updates/s)")
+    print(f"Including slow commands: {finished:.3f} s ({len(parsed) / finished:.0f} updates/s)")
+
+    print_latencies("Handler (dispatcher)", durations["stellite_handler_seconds"])
+    print_latencies("Slow command (incl. waiting)", durations["stellite_slow_handler_seconds"])
+
+    print(f"\n{'Bot API method':<30}{'calls':>8}")
+    for method, count in request.calls.most_common():
+        print(f"{method:<30}{count:>8}")
+
+    if args.alloc:
+        print(f"\nTraced memory: peak {peak / 2 ** 20:.1f} MiB, still allocated {current / 2 ** 20:.1f} MiB")
+        print(f"\nTop {TOP_ALLOCATIONS} sites of memory still allocated after replay:")
+        for stat in after.compare_to(before, "lineno")[:TOP_ALLOCATIONS]:
+            print(f"  {stat}")
+
+
+if __name__ == "__main__":
+    main()
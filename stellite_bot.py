@@ -1,28 +1,53 @@
+import time
+# Point in time when script got started. Needed to measure startup
+START_TIME = time.time()
+
+import atexit
+import bisect
+import csv
+import hashlib
+import hmac
+import html
+import io
 import json
 import logging
+import multiprocessing
 import os
+import queue
+import re
 import requests
+import select
+import signal
+import shutil
+import sqlite3
+import subprocess
 import sys
-import time
+import tempfile
 import threading
 import datetime
 
-import numpy as np
 import TradeOgre as to
-import twitter as twi
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
-
-from coinmarketcap import Market
-from flask import Flask, jsonify
-from collections import OrderedDict, Counter
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from urllib.parse import urlparse
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+from types import SimpleNamespace
+from xml.etree import ElementTree
+from collections import OrderedDict, Counter, deque
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from telegram import ParseMode, Chat, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, RegexHandler
+from telegram import Bot, ParseMode, Chat, MessageEntity, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram import InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, RegexHandler, TypeHandler
+from telegram.ext import InlineQueryHandler
+from telegram.ext import DispatcherHandlerStop
 from telegram.ext.filters import Filters
-from telegram.error import TelegramError, InvalidToken
+from telegram.error import TelegramError, InvalidToken, RetryAfter, BadRequest
+from telegram.utils.helpers import to_timestamp
+from telegram.utils.request import Request
 
 # TODO: Better logging
 # TODO: Image generation as Bytestream
@@ -35,6 +60,8 @@ SAVE_ANSWER, CREATE_TOPIC, CREATE_ANSWERS, CREATE_END, DELETE_POLL = range(5)
 POLL_IMG = "poll.png"
 # Configuration file
 CFG_FILE = "config.json"
+# Database for state that has to survive a restart
+STATE_FILE = "state.db"
 # Log file for errors
 LOG_FILE = "error.log"
 # Resource folder
@@ -45,47 +72,545 @@ KEY_FOLDER = "key"
 BOT_KEY = "bot.key"
 # File with Twitter keys / secrets
 TWITTER_KEY = "twitter.key"
+# File with secret token for webhook requests
+WEBHOOK_KEY = "webhook.key"
+# File with token for downloading poll exports via web (optional)
+EXPORT_KEY = "export.key"
+# File with token for reading metrics via web (optional, without it only local requests are allowed)
+METRICS_KEY = "metrics.key"
+# File with Tweets to use instead of Twitter timeline in dry run mode
+TWITTER_FAKE = "twitter_fake.json"
+# Number of item IDs per feed to remember to detect new items
+FEED_SEEN = 200
+# Seconds to wait for the webserver to accept connections
+WEB_TIMEOUT = 10
+# Upper bounds (seconds) of latency histogram buckets
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Description of exported metrics
+METRIC_HELP = {
+    "stellite_handler_seconds": "Time spent in handler on dispatcher thread",
+    "stellite_slow_handler_seconds": "Time from accepting a slow command until it finished",
+    "stellite_api_seconds": "Duration of outbound API calls"
+}
+# Longest allowed '/profile' run in seconds
+PROFILE_MAX_SEC = 60
+# Seconds between stack samples and max share of time spent on sampling
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_OVERHEAD = 0.02
+# Max distinct stacks to keep while profiling. Rarer ones get counted as 'other'
+PROFILE_MAX_STACKS = 5000
+# Number of functions to list in '/profile' summary
+PROFILE_TOP = 15
+# Number of error fingerprints to remember as already reported
+ERROR_FINGERPRINTS = 500
+# Number of chats to remember the last error reply for
+ERROR_REPLY_CHATS = 1000
+# Seconds until admins of a chat are looked up again after the lookup failed
+ADMIN_RETRY_SEC = 60
+# Bytes to read at once while downloading an update
+UPDATE_CHUNK = 64 * 1024
+# Seconds to wait for the state database if another process is writing to it
+STATE_TIMEOUT = 10
+# Commands that change the config file. With workers they go to the first worker, also from groups
+CFG_COMMANDS = ("config", "update")
+# Put into the update queue of a worker instead of an update to make it reload
+WORKER_RELOAD = "reload"
+# Seconds between checks if all worker processes are still running
+WORKER_CHECK_SEC = 5
+# Seconds a slow command can take before the user gets a "Working on it" message
+SLOW_ACK_SEC = 0.5
+# Number of messages that '/purge' deletes concurrently
+PURGE_THREADS = 5
+# Number of votes to read at once while exporting a poll and content type per export format
+POLL_EXPORT_CHUNK = 1000
+POLL_EXPORT_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+# Most typos that a searched wiki term can have and number of closest terms to suggest
+WIKI_MAX_TYPOS = 2
+WIKI_SUGGESTIONS = 5
 
 # Configuration file
 config = None
-# Bot is changing config file
-bot_changing_conf = False
+# Configuration per chat (global config merged with chat's entry in 'chats').
+# Keyed by chat ID and by '@username' so that a chat is found with one lookup
+chat_configs = dict()
+# Telegram admins per chat and time of lookup
+chat_admins = dict()
+# Search index and prepared answers for '/wiki'
+wiki_index = None
+# Content of config file as last read or written by this process. File events
+# without a change (like the ones of our own writes) don't cause a reload
+cfg_text = None
+cfg_lock = threading.Lock()
+# Connection to state database
+state_db = None
+state_lock = threading.Lock()
+# Last saved value for every state key - unchanged values don't get written again
+saved_state = dict()
+# ID of last update that the dispatcher processed
+last_update_id = None
+# Number of updates from before startup that got processed
+replayed_updates = 0
+# Telegram bot updater with its dispatcher and job queue
+updater = None
+dispatcher = None
+job_queue = None
+# Secret token for webhook requests and tokens for poll exports and metrics via web
+webhook_secret = None
+export_token = None
+metrics_token = None
+# Twitter keys and API (API gets created on first use)
+twitter_keys = None
+twitter_api = None
+# Pyplot module (gets loaded on first use)
+pyplot = None
+# Feeds to relay to the chat and session for all HTTP requests of feeds
+feeds = OrderedDict()
+feed_session = requests.Session()
+# Webserver for poll data and webhook
+web_server = None
+web_ready = threading.Event()
+# Watches for config file changes
+observer = None
+# Thread pool for slow commands and limit for running or waiting commands
+slow_executor = None
+slow_slots = None
+# Only one poll result image can be generated at a time
+plot_lock = threading.Lock()
+# Jobs that are currently running on the thread pool for slow commands
+running_jobs = set()
+running_jobs_lock = threading.Lock()
+# Latest coin data from CoinMarketCap (with time of retrieval) and rendered '/cmc' message
+cmc_coin = None
+cmc_msg = None
+# Failed CoinMarketCap refreshes in a row. Refresh interval doubles with each of them
+cmc_failures = 0
+# Enabled price sources, thread pool to fetch them concurrently and last merged quote
+price_sources = list()
+price_executor = None
+price_quote = None
+price_lock = threading.Lock()
+# Price alerts by ID, sorted (threshold, ID) lists per TradeOgre market and direction ('>' or '<'),
+# IDs of alerts per user and last price per market with time of retrieval. Thresholds of '>' are
+# always above the last price, thresholds of '<' below. So the alerts to fire are the ones in the
+# range that the price crossed
+alerts = dict()
+alert_thresholds = dict()
+alert_users = dict()
+alert_prices = dict()
+alert_lock = threading.Lock()
+# Results of inline queries with time of creation, least recently used first
+inline_cache = OrderedDict()
+inline_lock = threading.Lock()
+# New users per chat that will be welcomed together
+welcome_queue = dict()
+welcome_lock = threading.Lock()
+# Repeating jobs that were scheduled based on config by name, with the interval from config
+jobs = dict()
+# Pinned message ID and time of lookup per chat
+pinned_cache = dict()
+# Recent activity per chat and user to detect flooding
+flood_users = OrderedDict()
+flood_lock = threading.Lock()
+# Recent message IDs (with time) per chat and user, most recently active user last,
+# and number of all message IDs in there. Used to delete messages with '/purge'
+recent_msgs = OrderedDict()
+recent_count = 0
+recent_lock = threading.Lock()
+# Duration of startup phases in seconds
+startup_times = OrderedDict()
+# Errors per fingerprint since last digest, fingerprints that were already reported (loaded from
+# state database on first error) and time of last error reply per chat, least recent first
+error_digest = dict()
+error_lock = threading.Lock()
+error_known = None
+error_replies = OrderedDict()
+# Only one '/profile' can run at a time
+profile_lock = threading.Lock()
+# Latency histograms per metric name and labels
+metrics = dict()
+metrics_lock = threading.Lock()
+
+# Index of this worker process (None if this process isn't a worker). The process that
+# receives updates has one queue and process per worker to pass updates on
+worker_index = None
+worker_queues = list()
+worker_procs = list()
+# Workers send the index of the worker that got '/restart' here. The process that
+# receives updates then reloads itself and puts 'WORKER_RELOAD' into the other queues
+worker_control = None
+# Workers are started fresh instead of forked since this process already runs threads
+worker_context = multiprocessing.get_context("spawn")
+
+# Logging and thread that writes log records
+logger = logging.getLogger()
+log_listener = None
 
 
 # Read configuration file
 def read_cfg():
     if os.path.isfile(CFG_FILE):
         with open(CFG_FILE) as config_file:
-            global config
-            config = json.load(config_file)
+            global config, cfg_text
+            cfg_text = config_file.read()
+            config = json.loads(cfg_text)
     else:
         exit(f"ERROR: No configuration file '{CFG_FILE}' found")
 
+    init_chats()
+    init_wiki()
+
+
+# Index settings of all chats. Chats can be given by ID or '@username'. Needs
+# to be done again whenever a top level key of the global config changes
+def init_chats():
+    global chat_configs
+
+    new_configs = dict()
+    for chat_key, overlay in config["chats"].items():
+        if chat_key.lstrip("-").isdigit():
+            chat_key = int(chat_key)
+        else:
+            chat_key = chat_key.lower()
+
+        new_configs[chat_key] = {**config, **overlay}
+
+    chat_configs = new_configs
+
+
+# Return config for given chat. Chats without own settings use global config
+def chat_cfg(chat):
+    cfg = chat_configs.get(chat.id)
+
+    if cfg is None and chat.username:
+        cfg = chat_configs.get("@" + chat.username.lower())
+
+        # Next lookup of this chat only needs the ID
+        if cfg is not None:
+            chat_configs[chat.id] = cfg
+
+    return config if cfg is None else cfg
+
 
 # Write configuration file
 def write_cfg():
-    global bot_changing_conf
-    bot_changing_conf = True
+    global cfg_text
 
     if os.path.isfile(CFG_FILE):
-        with open(CFG_FILE, "w") as cfg:
-            json.dump(config, cfg, indent=4)
+        with cfg_lock:
+            cfg_text = json.dumps(config, indent=4)
+
+            # Other processes watch the file. Replacing it at once means they never read half of it
+            with open(CFG_FILE + ".tmp", "w") as cfg:
+                cfg.write(cfg_text)
+            os.replace(CFG_FILE + ".tmp", CFG_FILE)
     else:
         exit(f"ERROR: No configuration file '{CFG_FILE}' found")
 
+    init_chats()
 
-# Load config
-read_cfg()
+    if wiki_index.source != (config["wiki"], config["wiki_aliases"]):
+        init_wiki()
 
 
-# Logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
-logger = logging.getLogger()
+# Open state database
+def init_state():
+    global state_db
+
+    state_db = sqlite3.connect(STATE_FILE, timeout=STATE_TIMEOUT, check_same_thread=False)
+    # Readers don't block the writer. Needed since workers share the database
+    state_db.execute("PRAGMA journal_mode=WAL")
+    state_db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+    state_db.execute("CREATE TABLE IF NOT EXISTS polls "
+                     "(chat TEXT PRIMARY KEY, topic TEXT, answers TEXT, end_date TEXT)")
+    state_db.execute("CREATE TABLE IF NOT EXISTS poll_answers "
+                     "(chat TEXT, user_id INTEGER, user TEXT, answer TEXT, UNIQUE (chat, user_id))")
+    state_db.execute("CREATE TABLE IF NOT EXISTS poll_votes "
+                     "(id INTEGER PRIMARY KEY, chat TEXT, time REAL, user_id INTEGER, user TEXT, answer TEXT, "
+                     "previous TEXT)")
+
+    # Votes from before polls were per chat have no chat yet (see 'migrate_poll')
+    if "chat" not in [row[1] for row in state_db.execute("PRAGMA table_info(poll_votes)")]:
+        state_db.execute("ALTER TABLE poll_votes ADD COLUMN chat TEXT")
+
+    state_db.execute("CREATE TABLE IF NOT EXISTS alerts "
+                     "(id INTEGER PRIMARY KEY, user_id INTEGER, pair TEXT, op TEXT, price REAL, created REAL)")
+
+
+# Return value for given key from state database
+def get_state(key, default=None):
+    with state_lock:
+        row = state_db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+
+    return json.loads(row[0]) if row else default
+
+
+# Save value for given key in state database if it changed
+def set_state(key, value):
+    value = json.dumps(value)
+
+    with state_lock:
+        if saved_state.get(key) == value:
+            return
+
+        with state_db:
+            state_db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+        saved_state[key] = value
+
+
+# Read file from key folder and return its lines
+def read_key(key_file):
+    if os.path.isfile(os.path.join(KEY_FOLDER, key_file)):
+        with open(os.path.join(KEY_FOLDER, key_file), 'r') as f:
+            return f.read().splitlines()
+    else:
+        exit(f"ERROR: No key file '{key_file}' found in dir '{KEY_FOLDER}'")
+
+
+# Log to console and errors also to a rotated file. Threads that log only put
+# records into a queue. Formatting and writing is done by a background thread
+def init_logging():
+    global log_listener
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_file = LOG_FILE
+
+    # Processes can't share a rotated file. Every worker gets its own
+    if worker_index is not None:
+        formatter = logging.Formatter(f'%(asctime)s - worker {worker_index} - %(name)s - %(levelname)s - %(message)s')
+        log_file = f"{os.path.splitext(LOG_FILE)[0]}-worker{worker_index}.log"
+
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+
+    error_file = RotatingFileHandler(log_file,
+                                     maxBytes=config["log_max_bytes"],
+                                     backupCount=config["log_backups"],
+                                     delay=True)
+    error_file.setLevel(logging.ERROR)
+    error_file.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+
+    queue_handler = QueuedLogHandler(log_queue)
+    queue_handler.addFilter(DebugSampler())
+    logger.handlers = [queue_handler]
+
+    log_listener = QueueListener(log_queue, console, error_file, respect_handler_level=True)
+    log_listener.start()
+
+    # Write everything that is still queued when the script ends
+    atexit.register(log_listener.stop)
+
+    set_log_levels()
+
+
+# Set levels of loggers from config. Logger 'root' is the default for all others
+def set_log_levels():
+    for name, level in config["log_levels"].items():
+        logging.getLogger(None if name == "root" else name).setLevel(level.upper())
+
+
+# Queues records without formatting them first. Formatting happens on the listener
+# thread (standard 'QueueHandler' formats on the thread that logs)
+class QueuedLogHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Let at most 'log_debug_per_sec' debug records per logger and second through.
+# Number of dropped records is added to the next record that passes
+class DebugSampler(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        # Logger name -> [second, passed records, dropped records]
+        self.windows = dict()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+
+        second = int(record.created)
+
+        with self.lock:
+            window = self.windows.get(record.name)
+
+            if not window or window[0] != second:
+                dropped = window[2] if window else 0
+                window = self.windows[record.name] = [second, 0, 0]
+
+                if dropped:
+                    record.msg = f"({dropped} debug records dropped) {record.msg}"
+
+            if window[1] >= config["log_debug_per_sec"]:
+                window[2] += 1
+                return False
+
+            window[1] += 1
+            return True
+
+
+# Thread pool for commands with slow network or plotting work. This way
+# they can't block the dispatcher workers that handle all other updates
+def init_executor():
+    global slow_executor, slow_slots
+
+    slow_executor = ThreadPoolExecutor(max_workers=config["slow_workers"])
+    slow_slots = threading.BoundedSemaphore(config["slow_workers"] + config["slow_queue"])
+
+
+# Decorator to run a job on the thread pool for slow commands. That way the job
+# queue isn't blocked. A job doesn't start again if previous run is still busy
+def slow_job(func):
+    @wraps(func)
+    def _slow_job(bot, job):
+        with running_jobs_lock:
+            if func in running_jobs:
+                return
+            running_jobs.add(func)
+
+        def _run():
+            try:
+                func(bot, job)
+            except Exception as ex:
+                logger.exception(f"Job '{func.__name__}' failed: {ex}")
+            finally:
+                with running_jobs_lock:
+                    running_jobs.discard(func)
 
-error_file = logging.FileHandler(LOG_FILE, delay=True)
-error_file.setLevel(logging.ERROR)
+        slow_executor.submit(_run)
 
-logger.addHandler(error_file)
+    return _slow_job
+
+
+# Latency histogram with error count for one metric and label combination
+class Histogram(object):
+    def __init__(self):
+        # Last bucket is for everything above the biggest bound
+        self.buckets = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def observe(self, seconds, error):
+        self.buckets[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+        if error:
+            self.errors += 1
+
+
+# Record duration of one call
+def observe(name, labels, seconds, error=False):
+    key = (name, tuple(labels.items()))
+
+    with metrics_lock:
+        histogram = metrics.get(key)
+        if not histogram:
+            histogram = metrics[key] = Histogram()
+
+        histogram.observe(seconds, error)
+
+
+# Context manager to measure an outbound API call. Exceptions count as errors,
+# callers can also set 'error' if the API reports errors without raising
+class Measure(object):
+    def __init__(self, service, method):
+        self.labels = {"service": service, "method": method}
+        self.error = False
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe("stellite_api_seconds", self.labels, time.perf_counter() - self.start,
+                self.error or exc_type is not None)
+
+
+# Bot API requests that get measured per API method
+class TimedRequest(Request):
+    def get(self, url, timeout=None):
+        with Measure("telegram", url.rsplit("/", 1)[-1]):
+            return super().get(url, timeout=timeout)
+
+    def post(self, url, data, timeout=None):
+        with Measure("telegram", url.rsplit("/", 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+
+# Decorator to measure duration and errors of a handler callback
+def timed_handler(func):
+    @wraps(func)
+    def _timed_handler(bot, update, **kwargs):
+        start = time.perf_counter()
+        error = False
+
+        try:
+            return func(bot, update, **kwargs)
+        except DispatcherHandlerStop:
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            observe("stellite_handler_seconds", {"handler": func.__name__},
+                    time.perf_counter() - start, error)
+
+    _timed_handler.timed = True
+    return _timed_handler
+
+
+# Measure callbacks of given handlers (and of handlers inside conversations)
+def time_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            time_handlers(handler.entry_points)
+            time_handlers(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                time_handlers(state_handlers)
+        elif not getattr(handler.callback, "timed", False):
+            handler.callback = timed_handler(handler.callback)
+
+
+# Render all metrics in Prometheus text format
+def render_metrics():
+    def labels_str(labels):
+        return ",".join(f'{key}="{value}"' for key, value in labels)
+
+    with metrics_lock:
+        snapshot = [(name, labels, list(h.buckets), h.count, h.errors, h.sum)
+                    for (name, labels), h in sorted(metrics.items())]
+
+    lines = list()
+    for name in METRIC_HELP:
+        rows = [row for row in snapshot if row[0] == name]
+        if not rows:
+            continue
+
+        lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+        lines.append(f"# TYPE {name} histogram")
+
+        for _, labels, buckets, count, errors, total in rows:
+            cumulative = 0
+            for bound, bucket in zip(METRIC_BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{{{labels_str(labels + (("le", bound),))}}} {cumulative}')
+
+            lines.append(f"{name}_sum{{{labels_str(labels)}}} {total:.6f}")
+            lines.append(f"{name}_count{{{labels_str(labels)}}} {count}")
+
+        errors_name = name.replace("_seconds", "_errors_total")
+        lines.append(f"# HELP {errors_name} Failed calls of {name}")
+        lines.append(f"# TYPE {errors_name} counter")
+
+        for _, labels, _, _, errors, _ in rows:
+            lines.append(f"{errors_name}{{{labels_str(labels)}}} {errors}")
+
+    return "\n".join(lines) + "\n"
 
 
 # Initialize Flask to get poll results via web
@@ -94,58 +619,165 @@ app = Flask(__name__)
 
 # Make poll related data available over the web
 def poll_web():
-    app.run(host='0.0.0.0', port=config["poll_ws_port"])
+    global web_server
+
+    try:
+        web_server = make_server('0.0.0.0', config["poll_ws_port"], app, threaded=True)
+    except OSError as ex:
+        logger.error(f"Webserver can't be started: {ex}")
+        return
+    finally:
+        # Socket is listening (or failed) - no need to wait any longer
+        web_ready.set()
 
+    web_server.serve_forever()
 
-# Runs the bot on a local development server
-threading.Thread(target=poll_web).start()
 
+# Runs the webserver and waits until it accepts connections
+def init_web():
+    threading.Thread(target=poll_web, name="webserver", daemon=True).start()
 
-# Access poll data via web
+    if not web_ready.wait(WEB_TIMEOUT):
+        logger.error(f"Webserver not ready after {WEB_TIMEOUT} seconds")
+
+
+# Access poll data via web. Poll of the main chat or of the chat given as parameter 'chat'
 @app.route("/stellite-bot/<string:command>", methods=["GET"])
 def poll_data(command):
+    chat_key = poll_chat(request.args.get("chat"))
+    if not chat_key:
+        return jsonify(success=False, message="Unknown chat"), 404
+
+    current = get_poll(chat_key) or {"topic": str(), "answers": list(), "end": str()}
+
     if command == "poll":  # The question
-        return jsonify(success=True, message=config["poll"]["topic"], commad=command)
+        return jsonify(success=True, message=current["topic"], commad=command)
     if command == "answers":  # All possible answers
-        return jsonify(success=True, message=config["poll"]["answers"], commad=command)
+        return jsonify(success=True, message=current["answers"], commad=command)
     if command == "data":  # Users with their answers
-        return jsonify(success=True, message=config["poll"]["data"], commad=command)
+        return jsonify(success=True, message=poll_answers(chat_key), commad=command)
     else:  # Everything else
         return jsonify(success=False, message='Something went wrong...')
 
 
-# Wait until webserver is started
-time.sleep(1)
+# Stream poll export as CSV or NDJSON. Needs the token from 'key/export.key' as parameter 'token'
+@app.route("/stellite-bot/export/<string:fmt>", methods=["GET"])
+def poll_export_web(fmt):
+    if not export_token:
+        return jsonify(success=False, message="Export not enabled"), 404
+    if not hmac.compare_digest(request.args.get("token", str()), export_token):
+        return jsonify(success=False, message="Access denied"), 403
+    if fmt not in POLL_EXPORT_TYPES:
+        return jsonify(success=False, message="Format has to be 'csv' or 'ndjson'"), 404
+
+    chat_key = poll_chat(request.args.get("chat"))
+    if not chat_key:
+        return jsonify(success=False, message="Unknown chat"), 404
+
+    headers = {"Content-Disposition": f"attachment; filename=poll.{fmt}"}
+    return Response(poll_export_lines(fmt, chat_key), mimetype=POLL_EXPORT_TYPES[fmt], headers=headers)
+
+
+# Receive updates from Telegram if bot runs in webhook mode
+@app.route("/stellite-bot/webhook", methods=["POST"])
+def webhook():
+    if not config["webhook_url"]:
+        return jsonify(success=False, message="Webhook mode not active"), 404
+
+    # Only accept requests from Telegram. Without a secret token nothing is accepted
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", str())
+    if not webhook_secret or not hmac.compare_digest(token, webhook_secret):
+        return jsonify(success=False, message="Access denied"), 403
+
+    # Dispatcher can't keep up - Telegram will deliver the update again later
+    if dispatcher.update_queue.qsize() >= config["webhook_max_queue"]:
+        return jsonify(success=False, message="Too many pending updates"), 429, {"Retry-After": "5"}
+
+    update = Update.de_json(request.get_json(force=True), updater.bot)
+    dispatcher.update_queue.put(update)
+
+    return jsonify(success=True)
 
 
-# Read bot token from file
-if os.path.isfile(os.path.join(KEY_FOLDER, BOT_KEY)):
-    with open(os.path.join(KEY_FOLDER, BOT_KEY), 'r') as f:
-        bot_token = f.read().splitlines()
-else:
-    exit(f"ERROR: No key file '{BOT_KEY}' found in dir '{KEY_FOLDER}'")
+# Latency and error metrics for Prometheus. Needs the token from 'key/metrics.key' as parameter
+# 'token'. Without that file only requests from the same host are allowed
+@app.route("/metrics", methods=["GET"])
+def metrics_data():
+    if metrics_token:
+        allowed = hmac.compare_digest(request.args.get("token", str()), metrics_token)
+    else:
+        allowed = request.remote_addr in ("127.0.0.1", "::1")
+
+    if not allowed:
+        return jsonify(success=False, message="Access denied"), 403
+
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 
 # Set bot token, get dispatcher and job queue
-try:
-    updater = Updater(bot_token[0], request_kwargs={'read_timeout': 15, 'connect_timeout': 15})
-    dispatcher = updater.dispatcher
-    job_queue = updater.job_queue
-except InvalidToken:
-    exit("ERROR: Bot token not valid")
+def init_bot():
+    global updater, dispatcher, job_queue, twitter_keys, webhook_secret, export_token, metrics_token
+
+    try:
+        request = TimedRequest(con_pool_size=8, read_timeout=15, connect_timeout=15)
+        # Other API URL (e.g. local stand-in from 'fake_api.py') or the official one
+        bot = Bot(read_key(BOT_KEY)[0], base_url=config["bot_api_url"] or None, request=request)
+        updater = Updater(bot=bot)
+        dispatcher = updater.dispatcher
+        job_queue = updater.job_queue
+    except InvalidToken:
+        exit("ERROR: Bot token not valid")
+
+    # Twitter keys / secrets (only needed if there is a Twitter feed)
+    if any(feed_cfg["type"] == "twitter" for feed_cfg in config["feeds"]):
+        twitter_keys = read_key(TWITTER_KEY)
+
+    # Secret token for webhook requests
+    if config["webhook_url"]:
+        webhook_secret = read_key(WEBHOOK_KEY)[0]
+
+    # Poll exports via web are only possible with a token
+    if os.path.isfile(os.path.join(KEY_FOLDER, EXPORT_KEY)):
+        export_token = read_key(EXPORT_KEY)[0]
+
+    # Metrics can be read from other hosts only with a token
+    if os.path.isfile(os.path.join(KEY_FOLDER, METRICS_KEY)):
+        metrics_token = read_key(METRICS_KEY)[0]
+
+
+# Read secret token for webhook requests again since 'webhook_url' might have been set
+# after startup. A missing key file doesn't stop the bot here, webhook requests get denied
+def reload_webhook_secret():
+    global webhook_secret
+
+    if config["webhook_url"] and os.path.isfile(os.path.join(KEY_FOLDER, WEBHOOK_KEY)):
+        webhook_secret = read_key(WEBHOOK_KEY)[0]
+    elif config["webhook_url"]:
+        logger.error(f"Webhook requests get denied: no key file '{WEBHOOK_KEY}' found in dir '{KEY_FOLDER}'")
+
+
+# Return Twitter API. Module is loaded on first use since it's rarely needed
+def get_twitter_api():
+    global twitter_api
+
+    global twitter_keys
 
+    if config["feed_dry_run"]:
+        return FakeTwitterApi(TWITTER_FAKE)
 
-# Read Twitter keys / secrets from file
-if os.path.isfile(os.path.join(KEY_FOLDER, TWITTER_KEY)):
-    with open(os.path.join(KEY_FOLDER, TWITTER_KEY), 'r') as f:
-        twitter_keys = f.read().splitlines()
-else:
-    exit(f"ERROR: No key file '{TWITTER_KEY}' found in dir '{KEY_FOLDER}'")
+    if not twitter_api:
+        import twitter as twi
 
-# Set tokens for Twitter access
-twitter_api = twi.Api(consumer_key=twitter_keys[0],
-                      consumer_secret=twitter_keys[1],
-                      access_token_key=twitter_keys[2],
-                      access_token_secret=twitter_keys[3])
+        if not twitter_keys:
+            twitter_keys = read_key(TWITTER_KEY)
+
+        # Set tokens for Twitter access
+        twitter_api = twi.Api(consumer_key=twitter_keys[0],
+                              consumer_secret=twitter_keys[1],
+                              access_token_key=twitter_keys[2],
+                              access_token_secret=twitter_keys[3])
+
+    return twitter_api
 
 
 # Handler to handle config file changes
@@ -153,85 +785,381 @@ class CfgHandler(FileSystemEventHandler):
     @staticmethod
     def on_modified(event):
         if os.path.basename(event.src_path) == CFG_FILE:
-            global bot_changing_conf
-            if not bot_changing_conf:
-                read_cfg()
-                msg = "Config reloaded"
-                updater.bot.send_message(config["dev_user_id"], msg)
-            else:
-                bot_changing_conf = False
+            CfgHandler.cfg_changed()
+
+    # Config gets written to a temporary file first and then replaces the old one
+    @staticmethod
+    def on_moved(event):
+        if os.path.basename(event.dest_path) == CFG_FILE:
+            CfgHandler.cfg_changed()
+
+    # Reload if content differs from what this process read or wrote last
+    @staticmethod
+    def cfg_changed():
+        # Lock makes sure that a write of this process is either done or not started yet
+        try:
+            with cfg_lock, open(CFG_FILE) as config_file:
+                text = config_file.read()
+                changed = text != cfg_text
+        except OSError:
+            return
+
+        # Writes of this process and repeated events for the same change
+        if not changed:
+            return
+
+        # Editor is still writing the file. There is another event once it's done
+        try:
+            json.loads(text)
+        except ValueError:
+            return
+
+        reload_bot()
+
+        # Every process reloads, but only one of them reports it
+        if is_main_worker():
+            msg = "Config reloaded"
+            updater.bot.send_message(config["dev_user_id"], msg)
 
 
 # Watch for config file changes
-observer = Observer()
-observer.schedule(CfgHandler(), ".", recursive=True)
-observer.start()
+def init_watchdog():
+    global observer
+
+    observer = Observer()
+    observer.schedule(CfgHandler(), ".", recursive=True)
+    observer.start()
+
+
+# Twitter API stand-in for dry runs. Timeline is read from a local file
+# with a JSON list of Tweets (at least 'id' and 'text' for every Tweet)
+class FakeTwitterApi(object):
+    base_url = "https://api.twitter.com/1.1"
+
+    def __init__(self, timeline_file):
+        self.timeline_file = timeline_file
+        self.rate_limit = self
+
+    def GetUserTimeline(self, screen_name=None, since_id=None, count=None, **kwargs):
+        import twitter as twi
+
+        timeline = list()
+        if os.path.isfile(self.timeline_file):
+            with open(self.timeline_file) as timeline_file:
+                timeline = json.load(timeline_file)
+
+        # Newest Tweets first, like on Twitter
+        tweets = sorted((t for t in timeline if not since_id or t["id"] > since_id), key=lambda t: -t["id"])
+        return [twi.Status.NewFromJsonDict(tweet) for tweet in tweets[:count]]
+
+    def get_limit(self, url):
+        return SimpleNamespace(limit=900, remaining=900, reset=0)
+
+
+# Relays new items of one feed (Twitter account, RSS / Atom feed or GitHub
+# releases) to the chat. Checks more often after new items and less often if
+# feed is quiet - but never more often than the rate limit of the source allows
+class Feed(object):
+    def __init__(self, feed_cfg):
+        self.cfg = feed_cfg
+        self.key = "feed:" + feed_cfg["type"] + ":" + feed_cfg["source"]
+        self.chat_id = feed_cfg.get("chat_id") or config["chat_id"]
+
+        # Same source can be relayed to several chats
+        if feed_cfg.get("chat_id"):
+            self.key += ":" + str(feed_cfg["chat_id"])
+        self.interval = feed_cfg["interval"]
+        self.next_check = 0
+        self.running = False
+
+    def check(self, bot):
+        state = get_state(self.key) or self.legacy_state()
+        seen = state.get("seen")
+
+        try:
+            items, wait = FEED_FETCHERS[self.cfg["type"]](self.cfg["source"], state)
+        except Exception as ex:
+            self.interval = min(self.interval * 2, self.cfg["max_interval"])
+            logger.warning(f"Feed {self.key} failed ({repr(ex)}). Next check in {self.interval} seconds")
+            return
+
+        seen_ids = set(seen or list())
+        new_items = [(item_id, msg) for item_id, msg in items if item_id not in seen_ids]
 
+        # Items that are already there on first check are not new. If
+        # there are too many new items, only the newest get relayed
+        if seen is None:
+            skipped, relay = new_items, list()
+        else:
+            split = max(len(new_items) - config["feed_max_items"], 0)
+            skipped, relay = new_items[:split], new_items[split:]
+
+        done = [item_id for item_id, msg in skipped]
+
+        try:
+            for item_id, msg in relay:
+                if config["feed_dry_run"]:
+                    logger.info(f"Feed dry run: {msg}")
+                else:
+                    bot.send_message(chat_id=self.chat_id,
+                                     parse_mode=ParseMode.HTML,
+                                     text=msg)
+
+                done.append(item_id)
+        finally:
+            # Content has to be requested again if not all new items got relayed
+            if len(done) < len(new_items):
+                state.pop("etag", None)
+                state.pop("modified", None)
+
+            # Save state only once for all new items. Remember at least as many IDs as the
+            # feed lists, otherwise its oldest items would count as new on every check
+            keep = max(FEED_SEEN, len(items), len(seen or list()))
+            state["seen"] = ((seen or list()) + done)[-keep:]
+            set_state(self.key, state)
+
+        if new_items:
+            self.interval = self.cfg["interval"]
+        else:
+            self.interval = min(self.interval * 1.5, self.cfg["max_interval"])
+
+        self.interval = max(self.interval, wait)
+
+    # State for first check. Takes over the newest Tweet that was relayed before there were feeds
+    # ('last_tweet_id' in config), so Tweets that were posted while the bot got updated are relayed
+    def legacy_state(self):
+        if self.cfg["type"] != "twitter" or not config.get("last_tweet_id"):
+            return dict()
+        if self.cfg["source"].lower() != str(config.get("twitter_account")).lower():
+            return dict()
 
-# Check Twitter timeline for new Tweets repeatably
-def check_twitter(bot, job):
-    # Return all new Tweets (newer then saved one)
-    if config["last_tweet_id"]:
-        twitter = config["twitter_account"]
-        tweet_id = config["last_tweet_id"]
+        return {"seen": [config["last_tweet_id"]]}
 
-        timeline = twitter_api.GetUserTimeline(screen_name=twitter,
-                                               since_id=tweet_id,
-                                               include_rts=False,
-                                               trim_user=True,
-                                               exclude_replies=True)
 
-        if timeline:
-            for tweet in [i.AsDict() for i in reversed(timeline)]:
-                msg = "[New Tweet from " + twitter + "](http://www.twitter.com/" + \
-                      twitter + "/" + "status/" + str(tweet["id"]) + ")\n\n"
+# Request URL with shared session. Only returns a response if content changed since
+# last request. Also returns seconds to wait until next request is allowed
+def feed_request(url, state):
+    headers = dict()
 
-                bot.send_message(chat_id=config["chat_id"],
-                                 parse_mode=ParseMode.MARKDOWN,
-                                 text=msg)
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("modified"):
+        headers["If-Modified-Since"] = state["modified"]
 
-                update_cfg("last_tweet_id", tweet["id"])
+    with Measure("feed", urlparse(url).hostname):
+        response = feed_session.get(url, headers=headers, timeout=15)
 
-    # Return newest Tweet and save it as current one
+    wait = 0
+    if "Retry-After" in response.headers and response.headers["Retry-After"].isdigit():
+        wait = int(response.headers["Retry-After"])
+    elif response.headers.get("X-RateLimit-Reset"):
+        reset_in = int(response.headers["X-RateLimit-Reset"]) - time.time()
+        remaining = int(response.headers.get("X-RateLimit-Remaining", 1))
+        wait = reset_in / max(remaining, 1)
+
+    if response.status_code == 304:
+        return None, wait
+
+    response.raise_for_status()
+
+    state["etag"] = response.headers.get("ETag")
+    state["modified"] = response.headers.get("Last-Modified")
+
+    return response, wait
+
+
+# Return Tweets of Twitter account, oldest first
+def fetch_twitter(account, state):
+    api = get_twitter_api()
+
+    # Only Tweets that are newer than the newest known one
+    if state.get("seen"):
+        kwargs = {"since_id": max(state["seen"])}
     else:
-        timeline = twitter_api.GetUserTimeline(screen_name=config["twitter_account"],
-                                               count=1,
-                                               include_rts=False,
-                                               trim_user=True,
-                                               exclude_replies=True)
+        kwargs = {"count": 1}
+
+    with Measure("twitter", "user_timeline"):
+        timeline = api.GetUserTimeline(screen_name=account,
+                                       include_rts=False,
+                                       trim_user=True,
+                                       exclude_replies=True,
+                                       **kwargs)
+
+    items = list()
+    for tweet in reversed(timeline):
+        url = "http://www.twitter.com/" + account + "/status/" + str(tweet.id)
+        items.append((tweet.id, '<a href="' + url + '">New Tweet from ' + html.escape(account) + '</a>'))
+
+    # Spread remaining requests until rate limit gets reset
+    limit = api.rate_limit.get_limit(api.base_url + "/statuses/user_timeline.json")
+    reset_in = int(limit.reset) - time.time()
+
+    return items, reset_in / max(int(limit.remaining), 1) if reset_in > 0 else 0
+
+
+# Return items of RSS or Atom feed, oldest first
+def fetch_rss(url, state):
+    response, wait = feed_request(url, state)
+
+    if response is None:
+        return list(), wait
+
+    root = ElementTree.fromstring(response.content)
+    atom = "{http://www.w3.org/2005/Atom}"
+
+    items = list()
+
+    # RSS
+    for item in root.findall("./channel/item"):
+        link = item.findtext("link", str())
+        item_id = item.findtext("guid") or link
+        items.append((item_id, item.findtext("title", str()), link))
+
+    # Atom
+    for entry in root.findall(atom + "entry"):
+        link = entry.find(atom + "link")
+        link = link.get("href", str()) if link is not None else str()
+        item_id = entry.findtext(atom + "id") or link
+        items.append((item_id, entry.findtext(atom + "title", str()), link))
+
+    title = root.findtext("./channel/title") or root.findtext(atom + "title") or url
+
+    return [(item_id, html.escape(title) + ': <a href="' + html.escape(link) + '">' + html.escape(item_title) + '</a>')
+            for item_id, item_title, link in reversed(items)], wait
+
+
+# Return releases of GitHub repository ('owner/repo'), oldest first
+def fetch_github(repo, state):
+    response, wait = feed_request("https://api.github.com/repos/" + repo + "/releases", state)
+
+    if response is None:
+        return list(), wait
+
+    items = list()
+    for release in reversed(response.json()):
+        if release["draft"]:
+            continue
 
-        if timeline:
-            update_cfg("last_tweet_id", timeline[0].AsDict()["id"])
+        name = release["name"] or release["tag_name"]
+        items.append((release["id"], 'New release of ' + html.escape(repo) + ': <a href="' +
+                      release["html_url"] + '">' + html.escape(name) + '</a>'))
+
+    return items, wait
+
+
+# Functions that return new items for every feed type
+FEED_FETCHERS = {"twitter": fetch_twitter, "rss": fetch_rss, "github": fetch_github}
+
+
+# Run all feeds that are due on the thread pool for slow commands. Every running feed takes
+# a slot like a slow command, so feeds can't fill the pool. Feeds without a slot wait for next tick
+def check_feeds(bot, job):
+    now = time.time()
+
+    for feed in feeds.values():
+        if feed.running or feed.next_check > now:
+            continue
+
+        if not slow_slots.acquire(blocking=False):
+            break
+
+        feed.running = True
+        slow_executor.submit(run_feed, bot, feed)
+
+
+# Check feed for new items and set time for next check
+def run_feed(bot, feed):
+    try:
+        feed.check(bot)
+    finally:
+        feed.next_check = time.time() + feed.interval
+        feed.running = False
+        slow_slots.release()
+
+
+# Create feeds from config. Feeds that already exist keep their state
+def init_feeds():
+    global feeds
+
+    new_feeds = OrderedDict()
+
+    for feed_cfg in config["feeds"]:
+        feed = Feed(feed_cfg)
+        if feed.key in feeds:
+            feeds[feed.key].cfg = feed_cfg
+            feeds[feed.key].chat_id = feed.chat_id
+            feed = feeds[feed.key]
+        new_feeds[feed.key] = feed
+
+    feeds = new_feeds
 
 
 # Post messages repeatably
 def repost_msg(bot, job):
-    bot.send_message(chat_id=config["chat_id"],
+    bot.send_message(chat_id=job.context["chat_id"],
                      parse_mode=ParseMode.MARKDOWN,
                      text=job.context["text"])
 
 
-# Add Telegram group admins to admin-list for this bot
-def add_tg_admins(bot, update):
-    tg_admins = bot.get_chat_administrators(config["chat_id"])
-    tg_admin_list = [admin["user"].id for admin in tg_admins]
+# Return IDs of Telegram admins of a chat. Cached for some time
+def get_tg_admins(bot, chat_id):
+    if chat_id in chat_admins:
+        admins, cached_at = chat_admins[chat_id]
 
-    if all(admin in config["adm_list"] for admin in tg_admin_list):
-        return
+        if time.time() - cached_at < config["admin_cache_sec"]:
+            return admins
+
+    # Another worker (or the process before a restart) might have looked them up already
+    admins, cached_at = get_state(f"admins:{chat_id}", (list(), 0))
+
+    if time.time() - cached_at < config["admin_cache_sec"]:
+        chat_admins[chat_id] = (set(admins), cached_at)
+        return chat_admins[chat_id][0]
+
+    try:
+        admins = {admin.user.id for admin in bot.get_chat_administrators(chat_id)}
+    except TelegramError as ex:
+        logger.warning(f"Can't get admins of chat {chat_id}: {ex}")
+
+        # Counts as no admins until the next try, otherwise every message would ask again
+        chat_admins[chat_id] = (set(), time.time() - max(config["admin_cache_sec"] - ADMIN_RETRY_SEC, 0))
+        return set()
+
+    chat_admins[chat_id] = (admins, time.time())
+    set_state(f"admins:{chat_id}", (sorted(admins), time.time()))
+    return admins
+
+
+# Check if user is admin in given chat. Bot admins from 'adm_list' are admins everywhere. In
+# private chats, Telegram admins of the main chat count. In groups, admins of that group
+def is_admin(bot, chat, user_id):
+    cfg = chat_cfg(chat)
+
+    if user_id in config["adm_list"] or user_id in cfg["adm_list"]:
+        return True
+
+    if not cfg["add_tg_admins"]:
+        return False
+
+    chat_id = config["chat_id"] if chat.type == Chat.PRIVATE else chat.id
+    return bool(chat_id) and user_id in get_tg_admins(bot, chat_id)
+
+
+# Check if user can manage the poll of given chat: bot admins and admins of that chat
+def is_poll_admin(bot, chat_key, user_id):
+    cfg = chat_configs.get(int(chat_key) if chat_key.lstrip("-").isdigit() else chat_key, config)
+
+    if user_id in config["adm_list"] or user_id in cfg["adm_list"]:
+        return True
 
-    all_admins = list(set(config["adm_list"]) | set(tg_admin_list))
-    update_cfg("adm_list", all_admins)
+    return cfg["add_tg_admins"] and user_id in get_tg_admins(bot, chat_key)
 
 
 # Decorator to restrict access if user is not an admin
 def restrict_access(func):
+    @wraps(func)
     def _restrict_access(bot, update, **kwargs):
-        # Add Telegram group admins to admin list
-        if config["add_tg_admins"]:
-            add_tg_admins(bot, update)
-
-        # Check if user of msg is in admin list
-        if update.message.from_user.id in config["adm_list"]:
+        if is_admin(bot, update.message.chat, update.message.from_user.id):
             return func(bot, update, **kwargs)
 
         msg = "Access denied \U0001F6AB"
@@ -242,6 +1170,7 @@ def restrict_access(func):
 
 # Decorator to check if command can be used only in private chat with bot
 def check_private_chat(func):
+    @wraps(func)
     def _check_private_chat(bot, update, **kwargs):
         # Check if command is "private only"
         cmd = update.message.text
@@ -258,6 +1187,84 @@ def check_private_chat(func):
     return _check_private_chat
 
 
+# Decorator to run slow commands on their own thread pool. User gets an acknowledgement if
+# command doesn't finish within 'SLOW_ACK_SEC' and a message if it takes longer than 'timeout'
+def run_slow(timeout):
+    def _run_slow(func):
+        @wraps(func)
+        def __run_slow(bot, update, **kwargs):
+            if not slow_slots.acquire(blocking=False):
+                msg = "Bot is busy right now. Please try again in a moment \U000023F3"
+                update.message.reply_text(msg)
+                return
+
+            try:
+                start = time.perf_counter()
+                future = slow_executor.submit(func, bot, update, **kwargs)
+            except Exception:
+                # Slot is only released by '_done', which never runs without a future
+                slow_slots.release()
+                raise
+
+            # Acknowledgement that got sent (if any). Commands answered from a cache don't need one
+            ack = list()
+            ack_lock = threading.Lock()
+
+            def _ack():
+                with ack_lock:
+                    if future.done():
+                        return
+
+                    try:
+                        ack.append(update.message.reply_text("Working on it\u2026"))
+                    except TelegramError:
+                        pass
+
+            ack_timer = threading.Timer(SLOW_ACK_SEC, _ack)
+            ack_timer.start()
+
+            timer = threading.Timer(timeout, slow_timeout, args=(update, future))
+            timer.start()
+
+            def _done(done_future):
+                ack_timer.cancel()
+                timer.cancel()
+                slow_slots.release()
+
+                # Cancelled means it timed out before it even started
+                error = done_future.cancelled() or done_future.exception() is not None
+                observe("stellite_slow_handler_seconds", {"handler": func.__name__},
+                        time.perf_counter() - start, error)
+
+                # Waits if the acknowledgement is being sent right now
+                with ack_lock:
+                    for message in ack:
+                        try:
+                            message.delete()
+                        except TelegramError:
+                            pass
+
+                if not done_future.cancelled() and done_future.exception():
+                    dispatcher.dispatch_error(update, done_future.exception())
+
+            future.add_done_callback(_done)
+
+        return __run_slow
+
+    return _run_slow
+
+
+# Called if a slow command didn't finish in time
+def slow_timeout(update, future):
+    # Command didn't even start yet
+    if future.cancel():
+        msg = "Request timed out. Please try again later \U00002639"
+    else:
+        msg = "This takes longer than expected. Still working on it\u2026"
+
+    update.message.reply_text(msg)
+
+
 # Create a button menu to show in messages
 def build_menu(buttons, n_cols=1, header_buttons=None, footer_buttons=None):
     menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
@@ -355,59 +1362,326 @@ def change_cfg(bot, update, args):
             else:
                 update_cfg(key, value)
 
-    # Restart bot to activate new settings
+    # Reload bot to activate new settings
     restart_bot(bot, update)
 
 
+# Return ID of pinned message in given chat. Cached to not query the chat on every join
+def get_pinned_msg_id(bot, chat_id):
+    if chat_id in pinned_cache:
+        msg_id, cached_at = pinned_cache[chat_id]
+
+        if time.time() - cached_at < config["pinned_cache_sec"]:
+            return msg_id
+
+    pinned_msg = bot.get_chat(chat_id).pinned_message
+    msg_id = pinned_msg.message_id if pinned_msg else None
+
+    pinned_cache[chat_id] = (msg_id, time.time())
+    return msg_id
+
+
+# Refresh cached pinned message if a new message gets pinned
+def pinned(bot, update):
+    msg_id = update.message.pinned_message.message_id
+    pinned_cache[update.message.chat_id] = (msg_id, time.time())
+
+
 # Greet new members with a welcome message
 def welcome(bot, update):
-    if config["welcome_new_usr"]:
+    cfg = chat_cfg(update.message.chat)
+
+    if cfg["welcome_new_usr"]:
         try:
-            if config["rem_joined_msg"]:
+            if cfg["rem_joined_msg"]:
                 # Remove default user-joined message
                 update.message.delete()
         except TelegramError:
             # Bot doesn't have admin rights
             pass
 
-        for user in update.message.new_chat_members:
-            if user.username:
-                msg = "Welcome @" + user.username
-            else:
-                msg = "Welcome <b>" + user.first_name + "</b>"
+        chat_id = update.message.chat_id
 
-            pinned_msg = bot.get_chat(update.message.chat_id).pinned_message
+        with welcome_lock:
+            first_join = chat_id not in welcome_queue
+            users = welcome_queue.setdefault(chat_id, OrderedDict())
 
-            # If config has welcome message, use it
-            if config["welcome_msg"]:
-                welcome_msg = "".join(config["welcome_msg"])
+            for user in update.message.new_chat_members:
+                users[user.id] = user
+
+        # Wait for more users to join and welcome all of them with one message
+        if first_join:
+            job_queue.run_once(send_welcome, cfg["welcome_delay"], context=update.message.chat)
+
+
+# Send one welcome message for all users that joined since the last one
+def send_welcome(bot, job):
+    chat = job.context
+    chat_id = chat.id
+    cfg = chat_cfg(chat)
+
+    with welcome_lock:
+        users = list(welcome_queue.pop(chat_id, dict()).values())
+
+    if not users:
+        return
+
+    # If config has welcome message, use it
+    if cfg["welcome_msg"]:
+        welcome_msg = "".join(cfg["welcome_msg"])
+    else:
+        pinned_msg_id = get_pinned_msg_id(bot, chat_id)
+
+        if pinned_msg_id:
+            # Public groups have a username, links to private ones use the ID without '-100'
+            if chat.username:
+                url = "t.me/" + chat.username + "/" + str(pinned_msg_id)
             else:
-                if pinned_msg:
-                    url = "t.me/" + config["chat_id"][1:] + "/" + str(pinned_msg.message_id)
+                url = "t.me/c/" + str(chat_id)[4:] + "/" + str(pinned_msg_id)
 
-                    welcome_msg = ['Please take a minute to read the <a href="' + url +
-                                   '">pinned message</a>. It includes rules for this group '
-                                   'and also important information regarding Stellite.']
-                else:
-                    return
+            welcome_msg = 'Please take a minute to read the <a href="' + url + \
+                          '">pinned message</a>. It includes rules for this group ' \
+                          'and also important information regarding Stellite.'
+        else:
+            return
+
+    names = list()
+    for user in users[:cfg["welcome_max_usr"]]:
+        if user.username:
+            names.append("@" + user.username)
+        else:
+            names.append("<b>" + html.escape(user.first_name) + "</b>")
+
+    # Don't mention everybody if too many users joined at once
+    if len(users) > cfg["welcome_max_usr"]:
+        names.append("and " + str(len(users) - cfg["welcome_max_usr"]) + " more")
+
+    msg = "Welcome " + ", ".join(names)
+
+    bot.send_message(
+        chat_id=chat_id,
+        text=msg + ". " + welcome_msg,
+        disable_notification=True,
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=True)
+
+
+# Recent messages of one user in one chat. Counters always
+# reflect the content of the 'events' ring buffer
+class UserActivity(object):
+    __slots__ = ("events", "hashes", "links", "media", "strikes", "last_seen")
+
+    def __init__(self):
+        self.events = deque()
+        self.hashes = dict()
+        self.links = 0
+        self.media = 0
+        self.strikes = 0
+        self.last_seen = 0
+
+    # Add message to ring buffer and drop everything older than 'window'
+    def add(self, now, window, max_events, content_hash, link, media):
+        events = self.events
+
+        while events and (now - events[0][0] > window or len(events) >= max_events):
+            self.remove(events.popleft())
+
+        events.append((now, content_hash, link, media))
+        self.hashes[content_hash] = self.hashes.get(content_hash, 0) + 1
+        self.links += link
+        self.media += media
+        self.last_seen = now
+
+    # Update counters for a message that left the ring buffer
+    def remove(self, event):
+        _, content_hash, link, media = event
+
+        count = self.hashes[content_hash] - 1
+        if count:
+            self.hashes[content_hash] = count
+        else:
+            del self.hashes[content_hash]
+
+        self.links -= link
+        self.media -= media
+
+    # Forget all messages (but not the strikes)
+    def reset(self):
+        self.events.clear()
+        self.hashes.clear()
+        self.links = 0
+        self.media = 0
+
+
+# Save message in activity of user and return reason if user is flooding
+def track_activity(cfg, chat_id, user_id, content, link, media, now=None):
+    if now is None:
+        now = time.time()
+
+    key = (chat_id, user_id)
+
+    with flood_lock:
+        activity = flood_users.get(key)
+
+        if activity:
+            flood_users.move_to_end(key)
+        else:
+            # Evict least recently active users if idle for too long or too many
+            idle = config["flood_idle_min"] * 60
+            while flood_users:
+                oldest = next(iter(flood_users.values()))
+                if len(flood_users) < config["flood_max_usr"] and now - oldest.last_seen < idle:
+                    break
+                flood_users.popitem(last=False)
+
+            activity = flood_users[key] = UserActivity()
+
+        content_hash = hash(content)
+        activity.add(now, cfg["flood_window_sec"], cfg["flood_max_msg"] + 1, content_hash, link, media)
+
+        if len(activity.events) > cfg["flood_max_msg"]:
+            reason = "too many messages"
+        elif activity.hashes[content_hash] > cfg["flood_max_dup"]:
+            reason = "duplicate messages"
+        elif activity.links > cfg["flood_max_link"]:
+            reason = "too many links"
+        elif activity.media > cfg["flood_max_media"]:
+            reason = "too much media"
+        else:
+            return None
+
+        activity.reset()
+        activity.strikes += 1
+        return reason, activity.strikes
+
+
+# Mute or ban user if he is flooding the chat. Returns True if user got punished
+def check_flood(bot, update):
+    message = update.message
+    user = message.from_user
+    cfg = chat_cfg(message.chat)
+
+    # Users can't be muted in private chats
+    if message.chat.type == Chat.PRIVATE:
+        return False
+
+    if not cfg["flood_protect"] or is_admin(bot, message.chat, user.id):
+        return False
+
+    attachment = message.effective_attachment
+    if isinstance(attachment, list):
+        attachment = attachment[-1]
+
+    if message.text:
+        content = message.text.strip().lower()
+    elif message.caption:
+        content = message.caption.strip().lower()
+    elif attachment:
+        content = attachment.file_id
+    else:
+        content = str()
+
+    entities = message.entities + message.caption_entities
+    link = any(entity.type in (MessageEntity.URL, MessageEntity.TEXT_LINK) for entity in entities)
+    media = attachment is not None
+
+    result = track_activity(cfg, message.chat_id, user.id, content, int(link), int(media))
+
+    if not result:
+        return False
+
+    reason, strikes = result
+    logger.info(f"User {user.id} flooding chat {message.chat_id}: {reason} (strike {strikes})")
+
+    try:
+        message.delete()
+    except TelegramError:
+        # Bot doesn't have admin rights
+        pass
+
+    if strikes > cfg["flood_max_mute"]:
+        ban_user(bot, message.chat_id, user)
+    else:
+        mute_user(bot, message.chat_id, user, cfg["flood_mute_min"])
+
+    return True
+
+
+# Remember message in index of recent messages. If there are too many
+# messages in total, users that weren't active for the longest time are dropped
+def track_message(bot, update):
+    global recent_count
+
+    message = update.message
+    if not message.from_user:
+        return
+
+    key = (message.chat_id, message.from_user.id)
+
+    with recent_lock:
+        messages = recent_msgs.get(key)
 
-            bot.send_message(
-                chat_id=update.message.chat.id,
-                text=msg + ". " + "".join(welcome_msg),
-                disable_notification=True,
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True)
+        if messages is None:
+            messages = recent_msgs[key] = deque(maxlen=config["purge_usr_msgs"])
+        else:
+            recent_msgs.move_to_end(key)
+
+        # Oldest message of a full ring buffer gets dropped
+        if len(messages) < messages.maxlen:
+            recent_count += 1
+
+        messages.append((message.message_id, to_timestamp(message.date)))
+
+        while recent_count > config["purge_max_msgs"]:
+            _, oldest = recent_msgs.popitem(last=False)
+            recent_count -= len(oldest)
+
+
+# Remove recent messages of user from index and return their IDs, newest first. Either
+# all indexed messages, the last 'count' or the ones that were sent since 'since'
+def pop_recent_msgs(chat_id, user_id, count=None, since=None):
+    global recent_count
+
+    key = (chat_id, user_id)
+
+    with recent_lock:
+        messages = recent_msgs.get(key)
+        if not messages:
+            return list()
+
+        number = len(messages) if count is None else min(count, len(messages))
+
+        # Messages are in the order they were sent
+        if since is not None:
+            number = min(number, sum(1 for _, sent in messages if sent >= since))
+
+        message_ids = [messages.pop()[0] for _ in range(number)]
+        recent_count -= number
+
+        if not messages:
+            del recent_msgs[key]
+
+    return message_ids
+
+
+# Mute or ban users that are flooding the chat. Runs before the commands, so that
+# command spam counts too. Messages of a punished user don't get handled any further
+def stop_flood(bot, update):
+    if check_flood(bot, update):
+        raise DispatcherHandlerStop()
 
 
 # Analyze message and react on specific content
 def check_msg(bot, update):
+    cfg = chat_cfg(update.message.chat)
+
     # Ban bots if they try to post a message
-    if config["ban_bots"] and update.message.from_user.is_bot:
-        ban(bot, update, auto_ban=True)
+    if cfg["ban_bots"] and update.message.from_user.is_bot:
+        ban_user(bot, update.message.chat_id, update.message.from_user)
         return
 
     # Automatically reply to predefined content
-    if config["auto_reply"]:
+    if cfg["auto_reply"]:
         # Save message to analyze content
         txt = update.message.text.lower()
 
@@ -439,18 +1713,60 @@ def check_msg(bot, update):
             update.message.reply_photo(tech, caption=caption, parse_mode=ParseMode.MARKDOWN)
 
 
-# Get info about coin from CoinMarketCap
-@check_private_chat
-def cmc(bot, update):
-    # Get coin id if not already known
-    if not config["cmc_coin_id"]:
-        listings = Market().listings()
+# Return CoinMarketCap ID of coin. Gets looked up only once and is then saved.
+# None if the listings couldn't be read or don't have the coin
+def get_cmc_coin_id(market):
+    coin_id = config["cmc_coin_id"] or get_state("cmc_coin_id")
+
+    if not coin_id:
+        with Measure("coinmarketcap", "listings") as call:
+            listings = market.listings()
+            call.error = not isinstance(listings, dict) or "data" not in listings
+
+        # Error or rate limit reached
+        if call.error:
+            return None
+
         for listing in listings["data"]:
             if config["ticker_symbol"].upper() == listing["symbol"].upper():
-                update_cfg("cmc_coin_id", listing["id"])
+                coin_id = listing["id"]
+                set_state("cmc_coin_id", coin_id)
                 break
 
-    ticker = Market().ticker(config["cmc_coin_id"], convert="BTC")
+    return coin_id
+
+
+# Get info about coin from CoinMarketCap and render message for '/cmc'
+@slow_job
+def refresh_cmc(bot, job):
+    from coinmarketcap import Market
+
+    global cmc_coin, cmc_msg, cmc_failures
+
+    try:
+        market = Market(request_timeout=15)
+        coin_id = get_cmc_coin_id(market)
+
+        if coin_id is None:
+            ticker = "no CoinMarketCap ID for " + config["ticker_symbol"]
+        else:
+            with Measure("coinmarketcap", "ticker") as call:
+                ticker = market.ticker(coin_id, convert="BTC")
+                call.error = not isinstance(ticker, dict)
+    except Exception as ex:
+        # Every failure has to go through the backoff below
+        ticker = repr(ex)
+
+    # Error or rate limit reached - wait longer before trying again. Interval is calculated
+    # from the failures, so the backoff is kept if the job's interval got changed by a reload
+    if not isinstance(ticker, dict) or not ticker.get("data"):
+        cmc_failures += 1
+        job.interval = min(config["cmc_refresh_sec"] * 2 ** cmc_failures, config["cmc_refresh_max_sec"])
+        logger.warning(f"CoinMarketCap refresh failed ({ticker}). Next try in {job.interval} seconds")
+        return
+
+    cmc_failures = 0
+    job.interval = config["cmc_refresh_sec"]
 
     coin = ticker["data"]
     symbol = coin["symbol"]
@@ -469,7 +1785,8 @@ def cmc(bot, update):
     btc = coin["quotes"]["BTC"]
     p_btc = "{0:.8f}".format(float(btc["price"]))
 
-    msg = "`" + symbol + " " + p_usd + " USD | " + p_btc + " BTC\n" + \
+    cmc_coin = (coin, time.time())
+    cmc_msg = "`" + symbol + " " + p_usd + " USD | " + p_btc + " BTC\n" + \
         "1h " + c_1h + "% | 24h " + c_24h + "% | 7d " + c_7d + "%\n\n" + \
         "CMC Rank: " + rank + "\n" + \
         "Volume 24h: " + v_24h + " USD\n" + \
@@ -477,339 +1794,1300 @@ def cmc(bot, update):
         "Circ. Supply: " + sup_c + " " + symbol + "`\n\n" + \
         "[Stats from CoinMarketCap](https://coinmarketcap.com/currencies/" + slug + ")"
 
-    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    # Other workers don't refresh the data themselves
+    if worker_index is not None:
+        set_state("cmc", {"coin": coin, "time": cmc_coin[1], "msg": cmc_msg})
 
 
-# Get current price of XTL for all given asset pairs
-@check_private_chat
-def price(bot, update):
-    msg = "TradeOgre:\n"
+# Latest CoinMarketCap data (with time of retrieval) and '/cmc' message. Only one
+# process refreshes them, other workers read them from the state database
+def latest_cmc():
+    if not worker_index:
+        return cmc_coin, cmc_msg
 
-    for pair_dict in to.API().markets():
-        for pair, data in pair_dict.items():
-            if config["ticker_symbol"] in pair:
-                xtl_ticker = to.API().ticker(pair)
-                msg += xtl_ticker["price"] + " " + pair.split("-")[0].upper() + "\n"
-            break
+    data = get_state("cmc")
+    if not data:
+        return None, None
 
-    update.message.reply_text("`" + msg + "`", parse_mode=ParseMode.MARKDOWN)
+    return (data["coin"], data["time"]), data["msg"]
 
 
-# Display summaries for specific topics
+# Show info about coin from CoinMarketCap
 @check_private_chat
-def wiki(bot, update, args):
-    # Check if there are arguments
-    if len(args) > 0:
-        value = str()
-
-        # Lookup provided argument in config
-        if args[0].lower() in config["wiki"]:
-            value = "".join(config["wiki"][args[0].lower()])
-
-        if value:
-            # Check if value is an existing image
-            if os.path.isfile(os.path.join(RES_FOLDER, value)):
-                image = open(os.path.join(RES_FOLDER, value), 'rb')
-                update.message.reply_photo(image)
-            else:
-                update.message.reply_text(value, parse_mode=ParseMode.MARKDOWN)
-        else:
-            msg = "`No entry found`"
-            update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+def cmc(bot, update):
+    msg = latest_cmc()[1]
+
+    if msg:
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
     else:
-        msg = "`No search term provided. Here is a list of all possible terms:\n\n`"
+        msg = "No data from CoinMarketCap yet. Please try again in a moment"
+        update.message.reply_text(msg)
 
-        # Iterate over wiki-term dict and build a str out of it
-        terms = str()
 
-        for term in sorted(list(config["wiki"])):
-            terms += term + "\n"
+# Source for the price of the coin. Subclasses implement 'fetch()' that returns a dict with base
+# currency as key and (price, 24h volume in base currency) as value, and the time of the data
+class PriceSource(object):
+    name = None
+    # Seconds to wait for the source to respond
+    timeout = 10
 
-        update.message.reply_text(msg + "`" + terms + "`", parse_mode=ParseMode.MARKDOWN)
 
+# Prices from TradeOgre. One request returns all markets. The same prices are used for price alerts
+class TradeOgreSource(PriceSource):
+    name = "TradeOgre"
 
-# Show info about bot and all available commands
-@check_private_chat
-def help(bot, update):
-    # Check if user is admin
-    if update.message.from_user.id in config["adm_list"]:
-        msg = "".join(config["help_msg_adm"])
-        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-    else:
-        msg = "".join(config["help_msg"])
-        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    def fetch(self):
+        quotes = dict()
+        prices = dict()
 
+        with Measure("tradeogre", "markets"):
+            markets = to.API(timeout=self.timeout).markets()
 
-# Send feedback about bot to bot-developer
-@check_private_chat
-def feedback(bot, update, args):
-    if args and args[0]:
-        msg = "Thank you for the feedback! \U0001F44D"
-        update.message.reply_text(msg)
+        for pair_dict in markets:
+            for pair, data in pair_dict.items():
+                prices[pair] = float(data["price"])
 
-        # Send feedback to developer
-        user = update.message.from_user.username
+                base, coin = pair.split("-")
+                if coin.upper() == config["ticker_symbol"].upper():
+                    quotes[base.upper()] = (prices[pair], float(data["volume"]))
 
-        if user:
-            feedback_msg = "Feedback from @" + user + ": " + " ".join(args)
-            bot.send_message(chat_id=config["dev_user_id"], text=feedback_msg)
-        else:
-            feedback_msg = "Feedback: " + " ".join(args)
-            bot.send_message(chat_id=config["dev_user_id"], text=feedback_msg)
-    else:
-        msg = "No feedback entered \U00002757"
-        update.message.reply_text(msg)
+        # Sending waits for the rate limit, so it doesn't hold up '/price'
+        fired = fire_alerts(prices)
+        if fired:
+            slow_executor.submit(send_alerts, updater.bot, fired)
 
+        return quotes, time.time()
 
-# Poll functionality for users
-@check_private_chat
-def poll(bot, update, args):
-    # Normal poll
-    if len(args) == 0:
-        # Check if there is an active poll
-        if not config["poll"]["topic"]:
-            msg = "There is currently no active poll"
-            update.message.reply_text(msg)
-            return
 
-        # Check if end-date is reached
-        if config["poll"]["end"]:
-            now = datetime.datetime.utcnow()
-            end = datetime.datetime.strptime(config["poll"]["end"], "%Y-%m-%d %H:%M:%S")
+# Prices from CoinMarketCap. Data is kept up to date by job 'refresh_cmc'
+class CoinMarketCapSource(PriceSource):
+    name = "CoinMarketCap"
+    timeout = 1
 
-            if now > end:
-                ended = "Poll already ended.\nSee results with `/poll results`"
-                update.message.reply_text(ended, parse_mode=ParseMode.MARKDOWN)
-                return
+    def fetch(self):
+        coin_data = latest_cmc()[0]
+        if not coin_data:
+            return dict(), time.time()
 
-        # Check if user already gave an answer
-        user_name = update.message.from_user.first_name
-        if user_name in config["poll"]["data"]:
-            answered = "You already gave an answer but you can change it if you like"
-            update.message.reply_text(answered)
+        coin, retrieved = coin_data
+        usd = coin["quotes"]["USD"]
+        btc = coin["quotes"]["BTC"]
 
-        question = config["poll"]["topic"]
-        answers = config["poll"]["answers"]
+        # Volume is only available in USD
+        volume = usd["volume_24h"] / usd["price"] * btc["price"] if usd["price"] else 0
+        return {"BTC": (float(btc["price"]), float(volume))}, retrieved
 
-        # No answers predefined - user can enter what he wants
-        if answers[0] == "none":
-            menu = build_menu(["cancel"])
-            markup = ReplyKeyboardMarkup(menu, resize_keyboard=True)
-            update.message.reply_text(question, reply_markup=markup)
 
-        # Predefined answers, use has to choose from keyboard
-        else:
-            # Set number of columns for answer-buttons
-            if len(answers) > 3:
-                cols = 3
-            else:
-                cols = len(answers)
+# Fixed prices for testing. Can simulate slow sources
+class FakePriceSource(PriceSource):
+    def __init__(self, name, quotes, delay=0, age=0):
+        self.name = name
+        self.quotes = quotes
+        self.delay = delay
+        self.age = age
 
-            menu = build_menu(answers, n_cols=cols, footer_buttons=["cancel"])
-            markup = ReplyKeyboardMarkup(menu, resize_keyboard=True)
-            update.message.reply_text(question, reply_markup=markup)
+    def fetch(self):
+        time.sleep(self.delay)
+        return dict(self.quotes), time.time() - self.age
 
-        return SAVE_ANSWER
 
-    # Generate image of poll results
-    if args[0].lower() == "results":
-        return poll_results(bot, update)
+# Available price sources by name
+PRICE_SOURCES = {source.name: source for source in [TradeOgreSource, CoinMarketCapSource]}
 
-    # Create new poll
-    if args[0].lower() == "create":
-        # Check if a poll already exists
-        if config["poll"]["topic"]:
-            msg = "There is already an active poll.\nRemove it first with `/poll delete`"
-            update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
-            return ConversationHandler.END
 
-        msg = "Tell me the topic of the poll"
-        update.message.reply_text(msg)
-        return CREATE_TOPIC
+# Create price sources that are enabled in config
+def init_price_sources():
+    global price_sources, price_executor
 
-    # Delete currently active poll
-    if args[0].lower() == "delete":
-        if config["poll"]["topic"]:
-            msg = "Do you really want to remove the current poll?"
-            menu = build_menu(["yes", "no"], n_cols=2)
-            keyboard = ReplyKeyboardMarkup(menu, one_time_keyboard=True, resize_keyboard=True)
-            update.message.reply_text(msg, reply_markup=keyboard)
-            return DELETE_POLL
-        else:
-            msg = "Nothing to delete - no active poll"
-            update.message.reply_text(msg)
-            return ConversationHandler.END
+    if price_executor:
+        price_executor.shutdown(wait=False)
 
+    price_sources = [PRICE_SOURCES[name]() for name in config["price_sources"]]
+    price_executor = ThreadPoolExecutor(max_workers=max(len(price_sources) * 2, 1))
 
-# Generate image for poll results
-def poll_results(bot, update):
-    # Count and sort answers
-    counted = Counter(config["poll"]["data"].values())
-    data = OrderedDict(sorted(counted.items(), key=lambda t: t[1]))
 
-    answers = tuple(data.keys())
-    y_pos = np.arange(len(answers))
-    fig = plt.figure()
-    # Create horizontal bars
-    plt.barh(y_pos, list(data.values()))
-    # Create names on the y-axis
-    plt.yticks(y_pos, answers)
+# Fetch quotes from all price sources at the same time and merge them. Quotes
+# are cached for some seconds and only one fetch runs at a time
+def get_price():
+    global price_quote
 
-    # Add title and axis names
-    plt.title("Topic: " + config["poll"]["topic"])
-    plt.xlabel("number of answers")
-    plt.ylabel("answers")
+    with price_lock:
+        if price_quote and time.time() - price_quote["time"] < config["price_cache_sec"]:
+            return price_quote
 
-    # Create image
-    fig.savefig(os.path.join(RES_FOLDER, POLL_IMG))
+        start = time.time()
+        futures = [(source, price_executor.submit(source.fetch)) for source in price_sources]
 
-    plot = open(os.path.join(RES_FOLDER, POLL_IMG), 'rb')
+        quotes = dict()
+        errors = list()
 
-    user_name = update.message.from_user.first_name
+        for source, future in futures:
+            try:
+                result, retrieved = future.result(timeout=max(start + source.timeout - time.time(), 0))
+            except Exception as ex:
+                logger.warning(f"Price source {source.name} failed: {repr(ex)}")
+                errors.append(source.name)
+                continue
 
-    # Get user answer
-    if user_name in config["poll"]["data"]:
-        caption = "Your answer was '" + config["poll"]["data"][user_name] + "'"
-    else:
-        caption = "You didn't participate in the poll yet"
+            for base, (price, volume) in result.items():
+                quotes.setdefault(base, list()).append({
+                    "source": source.name,
+                    "price": price,
+                    "volume": volume,
+                    "age": time.time() - retrieved})
 
-    # Add total answers
-    data = len(config["poll"]["data"])
-    caption += "\nTotal answers: " + str(data)
+        price_quote = {"time": time.time(), "quotes": merge_quotes(quotes), "errors": errors}
+        return price_quote
 
-    # Add user participation
-    if config["chat_id"]:
-        members = bot.get_chat_members_count(config["chat_id"])
-        caption += " (participation: " + "{:.2f}".format(data / members * 100) + "%)"
 
-    # Add end-date for the poll
-    caption += "\nThe survey will end on " + config["poll"]["end"]
+# Calculate volume weighted average price for every base currency.
+# Leaves out quotes that are too old or too far away from the median
+def merge_quotes(quotes):
+    merged = dict()
 
-    update.message.reply_photo(
-        plot,
-        caption=caption,
-        parse_mode=ParseMode.MARKDOWN)
-    return ConversationHandler.END
+    for base, base_quotes in quotes.items():
+        for quote in base_quotes:
+            quote["rejected"] = quote["age"] > config["price_max_age_sec"]
 
+        valid = [quote for quote in base_quotes if not quote["rejected"]]
 
-# Set new topic for the poll
-@check_private_chat
-@restrict_access
-def poll_create_topic(bot, update, user_data):
-    user_data["topic"] = update.message.text
+        # With less than three quotes it's not possible to say which one is wrong
+        if len(valid) >= 3:
+            prices = sorted(quote["price"] for quote in valid)
+            middle = len(prices) // 2
+            median = prices[middle] if len(prices) % 2 else (prices[middle - 1] + prices[middle]) / 2
 
-    msg = "What are the possible answers? Comma separated like this: `yes, no, maybe` " \
-          "or send `none` if users can enter what they want."
-    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+            for quote in valid:
+                if median and abs(quote["price"] - median) / median > config["price_max_dev"]:
+                    quote["rejected"] = True
 
-    return CREATE_ANSWERS
+            valid = [quote for quote in valid if not quote["rejected"]]
 
+        if not valid:
+            continue
 
-# Set possible answers for poll
-def poll_create_answers(bot, update, user_data):
-    user_data["answers"] = [answer.lower().strip() for answer in update.message.text.split(",")]
+        volume = sum(quote["volume"] for quote in valid)
 
-    # Check entered answers
-    if len(user_data["answers"]) == 1 and user_data["answers"][0] != "none":
-        msg = "Wrong answers entered. Enter `none` for free choice " \
-              "or comma separated list like this: `yes, no, maybe`"
-        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
-        return CREATE_ANSWERS
+        if volume:
+            price = sum(quote["price"] * quote["volume"] for quote in valid) / volume
+        else:
+            price = sum(quote["price"] for quote in valid) / len(valid)
 
-    msg = "When should the poll end? Enter date and time in this form: `YYYY-MM-DD HH:MM:SS`"
-    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        merged[base] = {"price": price, "volume": volume, "sources": base_quotes}
 
-    return CREATE_END
+    return merged
 
 
-# Set the end-date for the current poll
-def poll_create_end(bot, update, user_data):
-    try:
-        # Check if given datetime is valid
-        datetime.datetime.strptime(update.message.text, '%Y-%m-%d %H:%M:%S')
-    except ValueError as ex:
-        msg = "Wrong format for end date entered. " \
-              "Enter date and time in this form: `YYYY-MM-DD HH:MM:SS`"
-        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
-        return CREATE_END
+# Return age in seconds as short, human readable string
+def format_age(seconds):
+    if seconds < 60:
+        return str(int(seconds)) + "s"
+    if seconds < 3600:
+        return str(int(seconds / 60)) + "m"
+    return str(int(seconds / 3600)) + "h"
 
-    user_data["end"] = update.message.text
 
-    config["poll"]["topic"] = user_data["topic"]
-    config["poll"]["answers"] = user_data["answers"]
-    config["poll"]["data"] = dict()
-    config["poll"]["end"] = user_data["end"]
+# Get current price of XTL for all given asset pairs
+@check_private_chat
+@run_slow(20)
+def price(bot, update):
+    quote = get_price()
 
-    user_data.clear()
+    if not quote["quotes"]:
+        msg = "No price available right now. Please try again later \U00002639"
+        update.message.reply_text(msg)
+        return
 
-    update_cfg("poll", config["poll"])
+    update.message.reply_text(price_msg(quote), parse_mode=ParseMode.MARKDOWN)
 
-    msg = "Poll is live! Let's get some answers \U0001F603"
-    update.message.reply_text(msg)
 
-    return ConversationHandler.END
+# Message with merged price per base currency and price of every source
+def price_msg(quote):
+    msg = str()
 
+    for base, merged in sorted(quote["quotes"].items()):
+        msg += "{0:.8f}".format(merged["price"]) + " " + base + "\n"
 
-# Delete currently active poll
-@check_private_chat
-@restrict_access
-def poll_delete(bot, update):
-    if update.message.text == "yes":
-        config["poll"]["topic"] = str()
-        config["poll"]["answers"] = list()
-        config["poll"]["data"] = dict()
-        config["poll"]["end"] = str()
+        for source in merged["sources"]:
+            msg += "  " + source["source"] + " " + "{0:.8f}".format(source["price"]) + \
+                   " (" + format_age(source["age"] + time.time() - quote["time"]) + ")"
 
-        update_cfg("poll", config["poll"])
+            if source["rejected"]:
+                msg += " ignored"
 
-        msg = "Poll cleared"
-        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+            msg += "\n"
 
-    else:
-        msg = "Canceled"
-        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+    if quote["errors"]:
+        msg += "\nNot available: " + ", ".join(quote["errors"])
 
-    return ConversationHandler.END
+    return "`" + msg + "`"
 
 
-# Save answer to poll in config
-def poll_save_answer(bot, update):
-    answer = update.message.text.lower()
+# Get new TradeOgre prices for alerts. They come from the price source, so TradeOgre is only
+# polled once for '/price' and alerts. Returns False if TradeOgre couldn't be reached
+def refresh_alert_prices():
+    for source in price_sources:
+        if isinstance(source, TradeOgreSource):
+            return source.name not in get_price()["errors"]
 
-    if answer == "cancel":
-        msg = "Poll canceled"
-        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
-        return ConversationHandler.END
+    # TradeOgre isn't a source for '/price'
+    try:
+        TradeOgreSource().fetch()
+    except Exception as ex:
+        logger.warning(f"Can't get TradeOgre prices for alerts: {repr(ex)}")
+        return False
 
-    global config
+    return True
 
-    # Check if answer is valid
-    answers = config["poll"]["answers"]
-    if answers[0] != "none" and answer not in answers:
-        msg = "Answer not allowed. Please try again"
-        update.message.reply_text(msg)
-        return SAVE_ANSWER
 
-    user = update.message.from_user.first_name
-    config["poll"]["data"][user] = answer.lower()
+# Market name for the way users write it: 'XTL-BTC' -> 'BTC-XTL'
+def alert_pair(pair):
+    return "-".join(reversed(pair.split("-")))
 
-    # Save config
-    write_cfg()
 
-    update.message.reply_text(
-        "Your answer has been saved \U0001F44D",
-        reply_markup=ReplyKeyboardRemove())
+# Save new prices and take all alerts that they trigger out of the index. Only the part
+# of the sorted thresholds that the price moved past gets touched. Returns triggered alerts
+def fire_alerts(prices):
+    fired = list()
+    fetched = time.time()
 
-    return ConversationHandler.END
+    with alert_lock:
+        for pair, price in prices.items():
+            alert_prices[pair] = (price, fetched)
 
+            # Thresholds up to the price (all of them were above the last price)
+            above = alert_thresholds.get((pair, ">"))
+            if above:
+                end = bisect.bisect_right(above, (price, float("inf")))
+                fired += above[:end]
+                del above[:end]
 
-# Check if there is an update available for this bot
-@check_private_chat
+            # Thresholds from the price on (all of them were below the last price)
+            below = alert_thresholds.get((pair, "<"))
+            if below:
+                start = bisect.bisect_left(below, (price,))
+                fired += below[start:]
+                del below[start:]
+
+        fired = [dict(alerts.pop(alert_id), id=alert_id) for _, alert_id in fired]
+
+        for data in fired:
+            data["now"] = alert_prices[data["pair"]][0]
+            alert_users[data["user_id"]].discard(data["id"])
+
+    if fired:
+        with state_lock, state_db:
+            state_db.executemany("DELETE FROM alerts WHERE id = ?", [(alert["id"],) for alert in fired])
+
+    return fired
+
+
+# Send triggered alerts. One message per user, at most 'alert_per_sec' messages per second
+def send_alerts(bot, fired):
+    user_lines = dict()
+
+    for alert in fired:
+        line = f"{alert_pair(alert['pair'])} is {'above' if alert['op'] == '>' else 'below'} " \
+               f"{alert['price']:.8f} (now {alert['now']:.8f})"
+        user_lines.setdefault(alert["user_id"], list()).append(line)
+
+    batch_start = time.time()
+
+    for number, (user_id, lines) in enumerate(user_lines.items()):
+        # Wait for the rest of the second after every batch
+        if number and number % config["alert_per_sec"] == 0:
+            time.sleep(max(1 - (time.time() - batch_start), 0))
+            batch_start = time.time()
+
+        msg = "\U0001F514 Price alert\n" + "\n".join(lines)
+
+        for _ in range(2):
+            try:
+                bot.send_message(chat_id=user_id, text=msg[:4096])
+                break
+            except RetryAfter as ex:
+                time.sleep(ex.retry_after)
+            except TelegramError as ex:
+                # User blocked the bot
+                logger.warning(f"Can't send price alert to user {user_id}: {ex}")
+                break
+
+
+# Get new TradeOgre prices. Alerts that they trigger get sent by the price source
+@slow_job
+def check_alerts(bot, job):
+    if not alerts:
+        return
+
+    refresh_alert_prices()
+
+
+# Get notified when the price of a TradeOgre market reaches a threshold. Usage:
+# '/alert XTL-BTC > 0.00000050', '/alert' to list own alerts, '/alert delete <ID | all>'
+@check_private_chat
+@run_slow(30)
+def alert(bot, update, args):
+    user_id = update.message.from_user.id
+
+    if not args:
+        with alert_lock:
+            own = [(alert_id, alerts[alert_id]) for alert_id in sorted(alert_users.get(user_id, list()))]
+
+        if not own:
+            msg = "You have no price alerts. Add one like this:\n/alert XTL-BTC > 0.00000050"
+        else:
+            msg = "Your price alerts:\n" + "\n".join(
+                f"{alert_id}: {alert_pair(data['pair'])} {data['op']} {data['price']:.8f}" for alert_id, data in own)
+
+        update.message.reply_text(msg)
+        return
+
+    if args[0].lower() == "delete" and len(args) == 2:
+        with alert_lock:
+            own = alert_users.get(user_id, set())
+            if args[1].lower() == "all":
+                remove = list(own)
+            else:
+                remove = [alert_id for alert_id in own if str(alert_id) == args[1]]
+
+            for alert_id in remove:
+                own.discard(alert_id)
+                data = alerts.pop(alert_id)
+                thresholds = alert_thresholds[(data["pair"], data["op"])]
+                del thresholds[bisect.bisect_left(thresholds, (data["price"], alert_id))]
+
+        with state_lock, state_db:
+            state_db.executemany("DELETE FROM alerts WHERE id = ?", [(alert_id,) for alert_id in remove])
+
+        update.message.reply_text(f"Removed {len(remove)} price alert(s)")
+        return
+
+    # Operator can be separated by spaces or not ('XTL-BTC>0.0000005')
+    match = re.fullmatch(r"([A-Za-z0-9]+-[A-Za-z0-9]+)\s*([<>])\s*([0-9]*\.?[0-9]+)", " ".join(args))
+
+    if not match:
+        msg = "Usage:\n/alert XTL-BTC > 0.00000050\n/alert XTL-BTC < 0.00000030\n/alert delete <ID | all>"
+        update.message.reply_text(msg)
+        return
+
+    name, op, threshold = match.group(1).upper(), match.group(2), float(match.group(3))
+    pair = alert_pair(name)
+
+    with alert_lock:
+        count = len(alert_users.get(user_id, list()))
+
+    if count >= config["alert_max_usr"]:
+        update.message.reply_text(f"You can't have more than {config['alert_max_usr']} price alerts")
+        return
+
+    # Alerts are checked against the last known price. Prices only get updated while there are
+    # alerts, so get a new one if there is none yet or it's older than one check interval
+    with alert_lock:
+        _, fetched = alert_prices.get(pair, (None, 0))
+
+    if time.time() - fetched > config["alert_check_sec"] and not refresh_alert_prices():
+        msg = "Can't get prices from TradeOgre right now. Please try again later"
+        update.message.reply_text(msg)
+        return
+
+    if pair not in alert_prices:
+        update.message.reply_text(f"There is no market {name} on TradeOgre")
+        return
+
+    with alert_lock:
+        now = alert_prices[pair][0]
+
+        if (op == ">" and now >= threshold) or (op == "<" and now <= threshold):
+            msg = f"{name} is already {'above' if op == '>' else 'below'} {threshold:.8f} (now {now:.8f})"
+            update.message.reply_text(msg)
+            return
+
+        created = time.time()
+
+        with state_lock, state_db:
+            cursor = state_db.execute("INSERT INTO alerts (user_id, pair, op, price, created) VALUES (?, ?, ?, ?, ?)",
+                                      (user_id, pair, op, threshold, created))
+
+        alert_id = cursor.lastrowid
+        alerts[alert_id] = {"user_id": user_id, "pair": pair, "op": op, "price": threshold, "created": created}
+        alert_users.setdefault(user_id, set()).add(alert_id)
+        bisect.insort(alert_thresholds.setdefault((pair, op), list()), (threshold, alert_id))
+
+    msg = f"Alert {alert_id}: you'll get a message when {name} is {'above' if op == '>' else 'below'} {threshold:.8f}"
+    update.message.reply_text(msg)
+
+
+# Build search index for wiki. Images that are added to the resource folder later need a reload
+def init_wiki():
+    global wiki_index
+    wiki_index = WikiIndex(config["wiki"], config["wiki_aliases"])
+
+
+# Wiki name for searching: lowercase words separated by one space ('Double-Spend' -> 'double spend')
+def wiki_key(text):
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+# Number of typos that are allowed in a searched word. Short words have to be exact
+def wiki_typos(word):
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 6:
+        return 1
+
+    return WIKI_MAX_TYPOS
+
+
+# Word and all variants of it with up to 'depth' characters removed
+def deletions(word, depth):
+    variants = current = {word}
+
+    for _ in range(depth):
+        current = {variant[:i] + variant[i + 1:] for variant in current for i in range(len(variant))}
+        variants = variants | current
+
+    return variants
+
+
+# Edit distance (insert, delete, replace, swap neighbours) of two words. None if more than 'max_distance'
+def edit_distance(word, other, max_distance):
+    if abs(len(word) - len(other)) > max_distance:
+        return None
+
+    before = None
+    previous = list(range(len(other) + 1))
+
+    for i in range(1, len(word) + 1):
+        current = [i] + [0] * len(other)
+
+        for j in range(1, len(other) + 1):
+            current[j] = min(previous[j] + 1,
+                             current[j - 1] + 1,
+                             previous[j - 1] + (word[i - 1] != other[j - 1]))
+
+            if i > 1 and j > 1 and word[i - 1] == other[j - 2] and word[i - 2] == other[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+
+        # Distance can't get smaller anymore
+        if min(current) > max_distance:
+            return None
+
+        before, previous = previous, current
+
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+# Wiki entries prepared for searching. Terms with the same content are one entry with several
+# names (aliases). Names are found by exact match, by a prefix of one of their words or by words
+# with typos. Lookups use dicts and a sorted word list, so they don't get slower with every entry
+class WikiIndex(object):
+    def __init__(self, wiki, aliases):
+        self.source = (wiki, aliases)
+        # Name -> content (image file or text) and content -> (path of image or None, text)
+        self.names = dict()
+        self.answers = dict()
+        # Word -> names that contain it, all words sorted for prefix search
+        # and variants of words with deleted characters -> words
+        self.words = dict()
+        self.deletes = dict()
+
+        for term, value in wiki.items():
+            content = "".join(value)
+            self.names[wiki_key(term)] = content
+
+            path = os.path.join(RES_FOLDER, content)
+            self.answers[content] = (path, None) if os.path.isfile(path) else (None, content)
+
+        for alias, term in aliases.items():
+            content = self.names.get(wiki_key(term))
+
+            if content is None:
+                logger.warning(f"Wiki alias '{alias}' points to unknown term '{term}'")
+            else:
+                self.names[wiki_key(alias)] = content
+
+        for name in self.names:
+            for word in name.split():
+                self.words.setdefault(word, set()).add(name)
+
+        for word in self.words:
+            for variant in deletions(word, WIKI_MAX_TYPOS):
+                self.deletes.setdefault(variant, set()).add(word)
+
+        self.sorted_words = sorted(self.words)
+
+        self.terms = "\n".join(sorted(wiki))
+        self.listing = "`No search term provided. Here is a list of all possible terms:\n\n``" + self.terms + "`"
+
+    # Names that contain the word with cost of the match: 0 = exact word, 1 = prefix, 2+ = typos
+    def match_word(self, word):
+        matches = dict()
+
+        def add(names, cost):
+            for name in names:
+                if cost < matches.get(name, cost + 1):
+                    matches[name] = cost
+
+        add(self.words.get(word, ()), 0)
+
+        # One character would match too much
+        if len(word) > 1:
+            index = bisect.bisect_left(self.sorted_words, word)
+
+            while index < len(self.sorted_words) and self.sorted_words[index].startswith(word):
+                add(self.words[self.sorted_words[index]], 1)
+                index += 1
+
+        typos = wiki_typos(word)
+
+        if typos:
+            candidates = set()
+            for variant in deletions(word, typos):
+                candidates.update(self.deletes.get(variant, ()))
+
+            for candidate in candidates:
+                distance = edit_distance(word, candidate, typos)
+                if distance:
+                    add(self.words[candidate], 1 + distance)
+
+        return matches
+
+    # Content for searched text and the name that was found. If there
+    # is no clear result, content is None and the closest names are returned
+    def search(self, text):
+        name = wiki_key(text)
+
+        if name in self.names:
+            return self.names[name], [name]
+
+        words = name.split()
+
+        # Name -> [number of matched words, cost]
+        totals = dict()
+
+        for word in words:
+            for match, cost in self.match_word(word).items():
+                total = totals.setdefault(match, [0, 0])
+                total[0] += 1
+                total[1] += cost
+
+        # Best name per entry. Most matched words first, then fewest typos
+        best = dict()
+
+        for match, (count, cost) in totals.items():
+            rank = (-count, cost, len(match), match)
+            content = self.names[match]
+
+            if content not in best or rank < best[content]:
+                best[content] = rank
+
+        ranked = sorted(best.values())
+
+        if not ranked:
+            return None, list()
+
+        # Clear result if all words matched and no other entry is as good
+        top = ranked[0]
+        if -top[0] == len(words) and (len(ranked) == 1 or ranked[1][:2] > top[:2]):
+            return self.names[top[-1]], [top[-1]]
+
+        return None, [rank[-1] for rank in ranked[:WIKI_SUGGESTIONS]]
+
+
+# State key for Telegram's ID of an uploaded wiki image. Changes if the image changes
+def wiki_file_key(path):
+    return f"wiki_file:{path}:{os.path.getmtime(path)}"
+
+
+# Send wiki image. Once uploaded, Telegram's ID for the file is sent instead of the file
+def send_wiki_image(update, path):
+    key = wiki_file_key(path)
+    file_id = get_state(key)
+
+    if file_id:
+        try:
+            update.message.reply_photo(file_id)
+            return
+        except BadRequest as ex:
+            logger.warning(f"Can't send wiki image '{path}' by file ID: {ex}")
+
+    with open(path, "rb") as image:
+        message = update.message.reply_photo(image)
+
+    set_state(key, message.photo[-1].file_id)
+
+
+# Display summaries for specific topics
+@check_private_chat
+def wiki(bot, update, args):
+    # List of all terms if there is nothing to search for
+    if not args:
+        update.message.reply_text(wiki_index.listing, parse_mode=ParseMode.MARKDOWN)
+        return
+
+    content, names = wiki_index.search(" ".join(args))
+
+    if content is None:
+        msg = "`No entry found`"
+
+        if names:
+            msg += "\n\nDid you mean:\n" + "\n".join(f"`/wiki {name}`" for name in names)
+
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        return
+
+    path, text = wiki_index.answers[content]
+
+    if path:
+        send_wiki_image(update, path)
+    else:
+        update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+
+
+# Answer inline queries like '@StelliteBot price' or '@StelliteBot wiki pow'. Results
+# are cached by Telegram and here, so many queries don't cause any work
+def inline_query(bot, update):
+    query = " ".join(update.inline_query.query.lower().split())
+    update.inline_query.answer(cached_inline_results(query), cache_time=config["inline_cache_sec"])
+
+
+# Results for inline query from cache if they are recent enough. Cache holds 'inline_cache_size' queries
+def cached_inline_results(query):
+    now = time.time()
+
+    with inline_lock:
+        cached = inline_cache.get(query)
+
+        if cached and now - cached[0] < config["inline_cache_sec"]:
+            inline_cache.move_to_end(query)
+            return cached[1]
+
+    results = inline_results(query)
+
+    # Price might just be on its way
+    if not results:
+        return results
+
+    with inline_lock:
+        inline_cache[query] = (now, results)
+        inline_cache.move_to_end(query)
+
+        while len(inline_cache) > config["inline_cache_size"]:
+            inline_cache.popitem(last=False)
+
+    return results
+
+
+# Build results for inline query. Start of 'price' or 'cmc' shows prices, everything else searches the wiki
+def inline_results(query):
+    if not query:
+        return inline_price() + inline_cmc()
+    if "price".startswith(query):
+        return inline_price()
+    if "cmc".startswith(query):
+        return inline_cmc()
+
+    if query.startswith("wiki"):
+        query = query[len("wiki"):].strip()
+
+    if not query:
+        msg = "Wiki terms:\n\n" + wiki_index.terms
+        return [InlineQueryResultArticle(id="wiki",
+                                         title="Wiki",
+                                         description="List of all terms",
+                                         input_message_content=InputTextMessageContent(msg))]
+
+    content, names = wiki_index.search(query)
+    results = list()
+
+    for name in names:
+        path, text = wiki_index.answers[wiki_index.names[name]]
+
+        if text:
+            results.append(InlineQueryResultArticle(id=f"wiki:{name}",
+                                                    title=name,
+                                                    description=" ".join(text.split())[:100],
+                                                    input_message_content=InputTextMessageContent(
+                                                        text, parse_mode=ParseMode.MARKDOWN)))
+            continue
+
+        # Images can only be sent by their file ID. They get one when '/wiki' sends them first
+        file_id = get_state(wiki_file_key(path))
+        if file_id:
+            results.append(InlineQueryResultCachedPhoto(id=f"wiki:{name}", photo_file_id=file_id, title=name))
+
+    return results
+
+
+# Inline result with last price. Never waits for the price sources,
+# an outdated price gets refreshed in the background
+def inline_price():
+    quote = price_quote
+
+    if not quote or time.time() - quote["time"] >= config["price_cache_sec"]:
+        # Already refreshing if locked
+        if not price_lock.locked():
+            slow_executor.submit(get_price)
+
+    if not quote or not quote["quotes"]:
+        return list()
+
+    msg = price_msg(quote)
+    description = ", ".join("{0:.8f} {1}".format(merged["price"], base)
+                            for base, merged in sorted(quote["quotes"].items()))
+
+    return [InlineQueryResultArticle(id="price",
+                                     title=f"{config['ticker_symbol']} price",
+                                     description=description,
+                                     input_message_content=InputTextMessageContent(msg, parse_mode=ParseMode.MARKDOWN))]
+
+
+# Inline result with CoinMarketCap info
+def inline_cmc():
+    msg = latest_cmc()[1]
+
+    if not msg:
+        return list()
+
+    return [InlineQueryResultArticle(id="cmc",
+                                     title="CoinMarketCap",
+                                     description=msg.split("\n")[0].strip("`"),
+                                     input_message_content=InputTextMessageContent(
+                                         msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True))]
+
+
+# Show info about bot and all available commands
+@check_private_chat
+def help(bot, update):
+    # Check if user is admin
+    if is_admin(bot, update.message.chat, update.message.from_user.id):
+        msg = "".join(config["help_msg_adm"])
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    else:
+        msg = "".join(config["help_msg"])
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+
+
+# Send feedback about bot to bot-developer
+@check_private_chat
+def feedback(bot, update, args):
+    if args and args[0]:
+        msg = "Thank you for the feedback! \U0001F44D"
+        update.message.reply_text(msg)
+
+        # Send feedback to developer
+        user = update.message.from_user.username
+
+        if user:
+            feedback_msg = "Feedback from @" + user + ": " + " ".join(args)
+            bot.send_message(chat_id=config["dev_user_id"], text=feedback_msg)
+        else:
+            feedback_msg = "Feedback: " + " ".join(args)
+            bot.send_message(chat_id=config["dev_user_id"], text=feedback_msg)
+    else:
+        msg = "No feedback entered \U00002757"
+        update.message.reply_text(msg)
+
+
+# Poll functionality for users. Every group has its own poll. Without a group
+# ('@username' or chat ID as first argument) the poll of the main chat is used
+@check_private_chat
+def poll(bot, update, args, user_data):
+    chat_key = poll_chat()
+
+    if args and (args[0].startswith("@") or args[0].lstrip("-").isdigit()):
+        chat_key = poll_chat(args.pop(0))
+
+        if not chat_key:
+            msg = "There are no polls for this group"
+            update.message.reply_text(msg)
+            return ConversationHandler.END
+
+    if not chat_key:
+        msg = "No group set. Use `/poll @group`"
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        return ConversationHandler.END
+
+    # Answers, new polls and deletions of this conversation belong to this chat
+    user_data["poll_chat"] = chat_key
+    current = get_poll(chat_key)
+
+    # Normal poll
+    if len(args) == 0:
+        # Check if there is an active poll
+        if not current:
+            msg = "There is currently no active poll"
+            update.message.reply_text(msg)
+            return
+
+        # Check if end-date is reached
+        if current["end"]:
+            now = datetime.datetime.utcnow()
+            end = datetime.datetime.strptime(current["end"], "%Y-%m-%d %H:%M:%S")
+
+            if now > end:
+                ended = "Poll already ended.\nSee results with `/poll results`"
+                update.message.reply_text(ended, parse_mode=ParseMode.MARKDOWN)
+                return
+
+        # Check if user already gave an answer
+        if poll_user_answer(chat_key, update.message.from_user):
+            answered = "You already gave an answer but you can change it if you like"
+            update.message.reply_text(answered)
+
+        question = current["topic"]
+        answers = current["answers"]
+
+        # No answers predefined - user can enter what he wants
+        if answers[0] == "none":
+            menu = build_menu(["cancel"])
+            markup = ReplyKeyboardMarkup(menu, resize_keyboard=True)
+            update.message.reply_text(question, reply_markup=markup)
+
+        # Predefined answers, use has to choose from keyboard
+        else:
+            # Set number of columns for answer-buttons
+            if len(answers) > 3:
+                cols = 3
+            else:
+                cols = len(answers)
+
+            menu = build_menu(answers, n_cols=cols, footer_buttons=["cancel"])
+            markup = ReplyKeyboardMarkup(menu, resize_keyboard=True)
+            update.message.reply_text(question, reply_markup=markup)
+
+        return SAVE_ANSWER
+
+    # Generate image of poll results
+    if args[0].lower() == "results":
+        if not current:
+            msg = "There is currently no active poll"
+            update.message.reply_text(msg)
+        else:
+            poll_results(bot, update, chat_key=chat_key)
+
+        return ConversationHandler.END
+
+    # Everything else is only for admins of the group
+    if not is_poll_admin(bot, chat_key, update.message.from_user.id):
+        msg = "Access denied \U0001F6AB"
+        update.message.reply_text(msg)
+        return ConversationHandler.END
+
+    # Create new poll
+    if args[0].lower() == "create":
+        # Check if a poll already exists
+        if current:
+            msg = "There is already an active poll.\nRemove it first with `/poll delete`"
+            update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+            return ConversationHandler.END
+
+        msg = "Tell me the topic of the poll"
+        update.message.reply_text(msg)
+        return CREATE_TOPIC
+
+    # Send all votes as file
+    if args[0].lower() == "export":
+        fmt = args[1].lower() if len(args) > 1 else "csv"
+
+        if fmt not in POLL_EXPORT_TYPES:
+            msg = "Usage: `/poll [@group] export [csv | ndjson]`"
+            update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        elif not current:
+            msg = "Nothing to export - no active poll"
+            update.message.reply_text(msg)
+        else:
+            poll_export(bot, update, fmt=fmt, chat_key=chat_key)
+
+        return ConversationHandler.END
+
+    # Delete currently active poll
+    if args[0].lower() == "delete":
+        if current:
+            msg = "Do you really want to remove the current poll?"
+            menu = build_menu(["yes", "no"], n_cols=2)
+            keyboard = ReplyKeyboardMarkup(menu, one_time_keyboard=True, resize_keyboard=True)
+            update.message.reply_text(msg, reply_markup=keyboard)
+            return DELETE_POLL
+        else:
+            msg = "Nothing to delete - no active poll"
+            update.message.reply_text(msg)
+            return ConversationHandler.END
+
+
+# Chat key of poll: the main chat if no chat is given. Otherwise the given chat ('@username' or
+# chat ID) if it's the main chat or has its own settings in 'chats'. None for all other chats
+def poll_chat(name=None):
+    main_chat = str(config["chat_id"]).lower() if config["chat_id"] else None
+
+    if name is None:
+        return main_chat
+
+    name = name.lower()
+    if name == main_chat or name in [chat_key.lower() for chat_key in config["chats"]]:
+        return name
+
+    return None
+
+
+# Poll of chat as dict with 'topic', 'answers' and 'end' (UTC). None if chat has no poll
+def get_poll(chat_key):
+    with state_lock:
+        row = state_db.execute("SELECT topic, answers, end_date FROM polls WHERE chat = ?", (chat_key,)).fetchone()
+
+    return {"topic": row[0], "answers": json.loads(row[1]), "end": row[2]} if row else None
+
+
+# Start new poll in chat. Answers and votes of the previous poll are removed
+def create_poll(chat_key, topic, answers, end):
+    delete_poll(chat_key)
+
+    with state_lock, state_db:
+        state_db.execute("INSERT INTO polls (chat, topic, answers, end_date) VALUES (?, ?, ?, ?)",
+                         (chat_key, topic, json.dumps(answers), end))
+
+
+# Remove poll of chat with all answers and votes
+def delete_poll(chat_key):
+    with state_lock, state_db:
+        for table in ("polls", "poll_answers", "poll_votes"):
+            state_db.execute(f"DELETE FROM {table} WHERE chat = ?", (chat_key,))
+
+
+# Current answer of every user that took part in poll of chat as {user: answer}
+def poll_answers(chat_key):
+    with state_lock:
+        rows = state_db.execute("SELECT user, answer FROM poll_answers WHERE chat = ?", (chat_key,)).fetchall()
+
+    return dict(rows)
+
+
+# Current answer of user in poll of chat. None if user didn't take part yet. Answers
+# that were moved over from config only have the name of the user (see 'migrate_poll')
+def poll_user_answer(chat_key, user):
+    with state_lock:
+        row = state_db.execute("SELECT answer FROM poll_answers WHERE chat = ? AND "
+                               "(user_id = ? OR user_id IS NULL AND user = ?)",
+                               (chat_key, user.id, user.first_name)).fetchone()
+
+    return row[0] if row else None
+
+
+# Number of users per answer in poll of chat, most answers first
+def poll_tally(chat_key):
+    with state_lock:
+        return state_db.execute("SELECT answer, COUNT(*) AS votes FROM poll_answers WHERE chat = ? "
+                                "GROUP BY answer ORDER BY votes DESC", (chat_key,)).fetchall()
+
+
+# Polls were kept in config before every group had its own. Move that poll to the main chat
+def migrate_poll():
+    if "poll" not in config:
+        return
+
+    old_poll = config.pop("poll")
+    chat_key = poll_chat()
+
+    if old_poll["topic"] and chat_key:
+        create_poll(chat_key, old_poll["topic"], old_poll["answers"], old_poll["end"])
+
+        with state_lock, state_db:
+            state_db.executemany("INSERT INTO poll_answers (chat, user_id, user, answer) VALUES (?, NULL, ?, ?)",
+                                 [(chat_key, user, answer) for user, answer in old_poll["data"].items()])
+            state_db.execute("UPDATE poll_votes SET chat = ? WHERE chat IS NULL", (chat_key,))
+
+    write_cfg()
+
+
+# Return pyplot. Module is loaded on first use since it takes long to import
+def get_pyplot():
+    global pyplot
+
+    if not pyplot:
+        import matplotlib
+        # Render to files only, there is no display
+        matplotlib.use('agg')
+        import matplotlib.pyplot as plt
+
+        pyplot = plt
+
+    return pyplot
+
+
+# Generate image for poll results
+@run_slow(30)
+def poll_results(bot, update, chat_key):
+    current = get_poll(chat_key)
+    if not current:
+        msg = "There is currently no active poll"
+        update.message.reply_text(msg)
+        return
+
+    # Answers with fewest votes first, so that the most votes are on top of the chart
+    data = OrderedDict(reversed(poll_tally(chat_key)))
+
+    # Pyplot isn't thread-safe and all results share the same image file
+    with plot_lock:
+        plt = get_pyplot()
+
+        answers = tuple(data.keys())
+        y_pos = range(len(answers))
+        fig = plt.figure()
+        # Create horizontal bars
+        plt.barh(y_pos, list(data.values()))
+        # Create names on the y-axis
+        plt.yticks(y_pos, answers)
+
+        # Add title and axis names
+        plt.title("Topic: " + current["topic"])
+        plt.xlabel("number of answers")
+        plt.ylabel("answers")
+
+        # Create image
+        fig.savefig(os.path.join(RES_FOLDER, POLL_IMG))
+        plt.close(fig)
+
+        plot = open(os.path.join(RES_FOLDER, POLL_IMG), 'rb')
+
+    # Get user answer
+    answer = poll_user_answer(chat_key, update.message.from_user)
+    if answer:
+        caption = "Your answer was '" + answer + "'"
+    else:
+        caption = "You didn't participate in the poll yet"
+
+    # Add total answers
+    data = sum(data.values())
+    caption += "\nTotal answers: " + str(data)
+
+    # Add user participation
+    members = bot.get_chat_members_count(chat_key)
+    caption += " (participation: " + "{:.2f}".format(data / members * 100) + "%)"
+
+    # Add end-date for the poll
+    caption += "\nThe survey will end on " + current["end"]
+
+    update.message.reply_photo(
+        plot,
+        caption=caption,
+        parse_mode=ParseMode.MARKDOWN)
+
+
+# Votes of the poll of a chat in the order they were given. Reads with its own database
+# connection in chunks, so memory use doesn't grow with the number of votes
+def poll_votes(chat_key):
+    connection = sqlite3.connect(STATE_FILE, timeout=STATE_TIMEOUT)
+
+    try:
+        cursor = connection.execute("SELECT time, user_id, user, answer, previous FROM poll_votes "
+                                    "WHERE chat = ? ORDER BY id", (chat_key,))
+
+        while True:
+            rows = cursor.fetchmany(POLL_EXPORT_CHUNK)
+            if not rows:
+                break
+
+            yield from rows
+    finally:
+        connection.close()
+
+
+# Lines of poll export. Every vote with time (UTC) and previous answer of the user if he
+# changed it, then number of votes per answer. Record type is in column 'record'
+def poll_export_lines(fmt, chat_key):
+    def utc(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+    tally = poll_tally(chat_key)
+
+    if fmt == "ndjson":
+        for timestamp, user_id, user, answer, previous in poll_votes(chat_key):
+            yield json.dumps({"record": "vote", "time": utc(timestamp), "user_id": user_id,
+                              "user": user, "answer": answer, "previous_answer": previous}) + "\n"
+
+        for answer, votes in tally:
+            yield json.dumps({"record": "tally", "answer": answer, "votes": votes}) + "\n"
+
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    # CSV writer needs a file. Take each line out of the buffer right away
+    def line(row):
+        writer.writerow(row)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    yield line(["record", "time", "user_id", "user", "answer", "previous_answer", "votes"])
+
+    for timestamp, user_id, user, answer, previous in poll_votes(chat_key):
+        yield line(["vote", utc(timestamp), user_id, user, answer, previous, None])
+
+    for answer, votes in tally:
+        yield line(["tally", None, None, None, answer, None, votes])
+
+
+# Send all votes of the poll of a chat as CSV or NDJSON file
+@run_slow(120)
+def poll_export(bot, update, fmt, chat_key):
+    current = get_poll(chat_key)
+    if not current:
+        msg = "Nothing to export - no active poll"
+        update.message.reply_text(msg)
+        return
+
+    tally = ", ".join(f"{answer}: {votes}" for answer, votes in poll_tally(chat_key))
+    caption = current["topic"] + "\n" + tally
+
+    # Export is written to a temporary file first, not built in memory
+    with tempfile.TemporaryFile() as export:
+        for text in poll_export_lines(fmt, chat_key):
+            export.write(text.encode("utf-8"))
+
+        export.seek(0)
+        update.message.reply_document(export, filename=f"poll.{fmt}", caption=caption[:200])
+
+
+# Set new topic for the poll
+@check_private_chat
+def poll_create_topic(bot, update, user_data):
+    # Conversations from before polls were per chat are about the main chat
+    user_data.setdefault("poll_chat", poll_chat())
+
+    if not is_poll_admin(bot, user_data["poll_chat"], update.message.from_user.id):
+        msg = "Access denied \U0001F6AB"
+        update.message.reply_text(msg)
+        return ConversationHandler.END
+
+    user_data["topic"] = update.message.text
+
+    msg = "What are the possible answers? Comma separated like this: `yes, no, maybe` " \
+          "or send `none` if users can enter what they want."
+    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+
+    return CREATE_ANSWERS
+
+
+# Set possible answers for poll
+def poll_create_answers(bot, update, user_data):
+    user_data["answers"] = [answer.lower().strip() for answer in update.message.text.split(",")]
+
+    # Check entered answers
+    if len(user_data["answers"]) == 1 and user_data["answers"][0] != "none":
+        msg = "Wrong answers entered. Enter `none` for free choice " \
+              "or comma separated list like this: `yes, no, maybe`"
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        return CREATE_ANSWERS
+
+    msg = "When should the poll end? Enter date and time in this form: `YYYY-MM-DD HH:MM:SS`"
+    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+
+    return CREATE_END
+
+
+# Set the end-date for the current poll
+def poll_create_end(bot, update, user_data):
+    try:
+        # Check if given datetime is valid
+        datetime.datetime.strptime(update.message.text, '%Y-%m-%d %H:%M:%S')
+    except ValueError as ex:
+        msg = "Wrong format for end date entered. " \
+              "Enter date and time in this form: `YYYY-MM-DD HH:MM:SS`"
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
+        return CREATE_END
+
+    user_data["end"] = update.message.text
+
+    create_poll(user_data["poll_chat"], user_data["topic"], user_data["answers"], user_data["end"])
+
+    user_data.clear()
+
+    msg = "Poll is live! Let's get some answers \U0001F603"
+    update.message.reply_text(msg)
+
+    return ConversationHandler.END
+
+
+# Delete currently active poll
+@check_private_chat
+def poll_delete(bot, update, user_data):
+    # Conversations from before polls were per chat are about the main chat
+    user_data.setdefault("poll_chat", poll_chat())
+
+    if not is_poll_admin(bot, user_data["poll_chat"], update.message.from_user.id):
+        msg = "Access denied \U0001F6AB"
+        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+
+    if update.message.text == "yes":
+        delete_poll(user_data["poll_chat"])
+
+        msg = "Poll cleared"
+        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+
+    else:
+        msg = "Canceled"
+        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+
+    return ConversationHandler.END
+
+
+# Save answer to poll in state database
+def poll_save_answer(bot, update, user_data):
+    answer = update.message.text.lower()
+
+    if answer == "cancel":
+        msg = "Poll canceled"
+        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+
+    # Conversations from before polls were per chat are about the main chat
+    chat_key = user_data.get("poll_chat") or poll_chat()
+    current = get_poll(chat_key) if chat_key else None
+
+    if not current:
+        msg = "There is currently no active poll"
+        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+
+    # Check if answer is valid
+    answers = current["answers"]
+    if answers[0] != "none" and answer not in answers:
+        msg = "Answer not allowed. Please try again"
+        update.message.reply_text(msg)
+        return SAVE_ANSWER
+
+    user = update.message.from_user
+    previous = poll_user_answer(chat_key, user)
+
+    # Current answer is replaced. Every vote is kept with its time for exports
+    with state_lock, state_db:
+        state_db.execute("DELETE FROM poll_answers WHERE chat = ? AND (user_id = ? OR user_id IS NULL AND user = ?)",
+                         (chat_key, user.id, user.first_name))
+        state_db.execute("INSERT INTO poll_answers (chat, user_id, user, answer) VALUES (?, ?, ?, ?)",
+                         (chat_key, user.id, user.first_name, answer))
+        state_db.execute("INSERT INTO poll_votes (chat, time, user_id, user, answer, previous) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (chat_key, time.time(), user.id, user.first_name, answer, previous))
+
+    update.message.reply_text(
+        "Your answer has been saved \U0001F44D",
+        reply_markup=ReplyKeyboardRemove())
+
+    return ConversationHandler.END
+
+
+# Check if there is an update available for this bot
+@check_private_chat
 @restrict_access
+@run_slow(20)
 def version_bot(bot, update):
     # Get newest version of this script from GitHub
     headers = {"If-None-Match": config["update_hash"]}
-    github_file = requests.get(config["update_url"], headers=headers)
+    github_file = requests.get(config["update_url"], headers=headers, timeout=15)
 
     # Status code 304 = Not Modified (same hash / same version)
     if github_file.status_code == 304:
@@ -824,115 +3102,398 @@ def version_bot(bot, update):
     update.message.reply_text(msg)
 
 
-# Update the bot to newest version on GitHub
-@check_private_chat
-@restrict_access
-def update_bot(bot, update):
-    # Get newest version of this script from GitHub
-    headers = {"If-None-Match": config["update_hash"]}
-    github_script = requests.get(config["update_url"], headers=headers)
+# Update the bot to newest version on GitHub without going offline
+@check_private_chat
+@restrict_access
+@run_slow(180)
+def update_bot(bot, update):
+    # Worker would hand over only itself instead of the whole bot
+    if worker_index is not None:
+        msg = "Not possible with worker processes. Update the script and restart the bot"
+        update.message.reply_text(msg)
+        return
+
+    # Get newest version of this script from GitHub
+    headers = {"If-None-Match": config["update_hash"]}
+    github_script = requests.get(config["update_url"], headers=headers, stream=True, timeout=15)
+
+    # Status code 304 = Not Modified
+    if github_script.status_code == 304:
+        msg = "You are running the latest version"
+        update.message.reply_text(msg)
+        return
+    # Every status code except 200 = OK
+    elif github_script.status_code != 200:
+        msg = f"Unexpected status code: {github_script.status_code}"
+        update.message.reply_text(msg)
+        return
+
+    msg = "Bot is updating..."
+    update.message.reply_text(msg)
+
+    script = os.path.abspath(sys.argv[0])
+    new_script = script + ".new"
+    old_script = script + ".bak"
+
+    # Running script stays untouched until the new one is complete and importable
+    try:
+        sha256 = download_update(github_script, new_script)
+        verify_update(new_script, sha256)
+    except Exception as ex:
+        logger.error(f"Update aborted: {ex}")
+        if os.path.isfile(new_script):
+            os.remove(new_script)
+
+        msg = f"Update aborted: {ex}"
+        update.message.reply_text(msg)
+        return
+
+    # Get github 'config.json' file
+    last_slash_index = config["update_url"].rfind("/")
+    github_config_path = config["update_url"][:last_slash_index + 1] + CFG_FILE
+    github_config_file = requests.get(github_config_path, timeout=15)
+    github_config = json.loads(github_config_file.text)
+
+    # Compare current config keys with config keys from github-config
+    if set(config) != set(github_config):
+        # Go through all keys in github-config and
+        # if they are not present in current config, add them
+        for key, value in github_config.items():
+            if key not in config:
+                config[key] = value
+
+    # Save ETag (hash) of new script and restart-user in config
+    old_hash = config["update_hash"]
+    update_cfg("update_hash", github_script.headers.get("ETag"))
+    update_cfg("restart_usr", update.message.chat_id)
+
+    # Keep the running version so that a failed start can be rolled back
+    shutil.copy2(script, old_script)
+    os.replace(new_script, script)
+
+    msg = f"Update verified (SHA-256 {sha256[:12]}). Starting new version..."
+    update.message.reply_text(msg)
+
+    # Only returns if the new process didn't get ready
+    hand_over()
+
+    os.replace(old_script, script)
+    update_cfg("update_hash", old_hash)
+    update_cfg("restart_usr", None)
+
+    msg = "New version didn't start. Rolled back, still running the old one"
+    update.message.reply_text(msg)
+
+
+# Stream response body to file and return its SHA-256 hash
+def download_update(response, path):
+    sha256 = hashlib.sha256()
 
-    # Status code 304 = Not Modified
-    if github_script.status_code == 304:
-        msg = "You are running the latest version"
-        update.message.reply_text(msg)
-    # Status code 200 = OK
-    elif github_script.status_code == 200:
-        msg = "Bot is updating..."
-        update.message.reply_text(msg)
+    with open(path, "wb") as file:
+        for chunk in response.iter_content(UPDATE_CHUNK):
+            sha256.update(chunk)
+            file.write(chunk)
 
-        # Get github 'config.json' file
-        last_slash_index = config["update_url"].rfind("/")
-        github_config_path = config["update_url"][:last_slash_index + 1] + CFG_FILE
-        github_config_file = requests.get(github_config_path)
-        github_config = json.loads(github_config_file.text)
+        file.flush()
+        os.fsync(file.fileno())
 
-        # Compare current config keys with config keys from github-config
-        if set(config) != set(github_config):
-            # Go through all keys in github-config and
-            # if they are not present in current config, add them
-            for key, value in github_config.items():
-                if key not in config:
-                    config[key] = value
+    # Content-Length is the size on the wire (maybe compressed)
+    length = response.headers.get("Content-Length")
+    if length and response.raw.tell() != int(length):
+        raise ValueError("Download incomplete")
 
-        # Save current ETag (hash) of bot script in config
-        update_cfg("update_hash", github_script.headers.get("ETag"))
+    return sha256.hexdigest()
 
-        # Get the name of the currently running script
-        path_split = os.path.split(str(sys.argv[0]))
-        filename = path_split[len(path_split)-1]
 
-        # Save the content of the remote file
-        with open(filename, "w") as file:
-            file.write(github_script.text)
+# Compare file with published hash (if any) and import it in a separate interpreter
+def verify_update(path, sha256):
+    hash_file = requests.get(config["update_url"] + ".sha256", timeout=15)
 
-        msg = "Update finished..."
-        update.message.reply_text(msg)
+    if hash_file.status_code == 200:
+        published = hash_file.text.split()
+        if not published or published[0].lower() != sha256:
+            raise ValueError("SHA-256 doesn't match published hash")
+    elif hash_file.status_code != 404:
+        raise ValueError(f"Can't get published hash: status {hash_file.status_code}")
+
+    # Importing has no side effects, so this only runs the module level code
+    smoke_test = ("import sys, importlib.util, importlib.machinery\n"
+                  "loader = importlib.machinery.SourceFileLoader('stellite_bot_update', sys.argv[1])\n"
+                  "spec = importlib.util.spec_from_loader(loader.name, loader)\n"
+                  "loader.exec_module(importlib.util.module_from_spec(spec))")
 
-        # Restart the bot
-        restart_bot(bot, update)
+    result = subprocess.run([sys.executable, "-c", smoke_test, path],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            timeout=config["update_ready_sec"])
 
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        raise ValueError("Import failed: " + (error[-1] if error else str(result.returncode)))
 
-# Restart bot (for example to reload changed config)
+
+# Reload config, handlers and jobs
 @check_private_chat
 @restrict_access
 def restart_bot(bot, update):
-    msg = "Restarting bot..."
+    duration = reload_bot()
+
+    msg = "Bot reloaded in " + "{0:.1f}".format(duration * 1000) + " ms"
+
+    # With workers, only this one got the command. The others get reloaded through the main process
+    if worker_control:
+        worker_control.put(worker_index)
+        msg += ". Other workers are reloading now"
+
     update.message.reply_text(msg)
 
-    # Set restart-user in config
-    update_cfg("restart_usr", update.message.chat_id, preload=True)
 
-    # Restart bot
-    time.sleep(0.2)
-    os.execl(sys.executable, sys.executable, *sys.argv)
+# Start new bot process and exit as soon as it's ready to take over polling.
+# Returns only if the new process didn't get ready in time
+def hand_over():
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+
+    # Don't pass on arguments of an earlier handoff
+    argv = list(sys.argv)
+    if "--handoff" in argv:
+        index = argv.index("--handoff")
+        del argv[index:index + 3]
+
+    process = subprocess.Popen([sys.executable, *argv, "--handoff", str(ready_w), str(go_r)],
+                               pass_fds=(ready_w, go_r))
+
+    os.close(ready_w)
+    os.close(go_r)
+
+    # New process writes one byte when it's warmed up. EOF means it died
+    readable, _, _ = select.select([ready_r], [], [], config["update_ready_sec"])
+    ready = bool(readable) and os.read(ready_r, 1) == b"1"
+    os.close(ready_r)
+
+    if not ready:
+        logger.error(f"Process {process.pid} didn't get ready, keeping this one")
+        process.kill()
+        process.wait()
+        os.close(go_w)
+        return
+
+    # Stop fetching updates (polling loop checks this flag) and free the port
+    updater.running = False
+    if web_server:
+        web_server.shutdown()
+        web_server.server_close()
+
+    # Let the dispatcher work off what was already fetched
+    deadline = time.time() + config["handoff_drain_sec"]
+    while not dispatcher.update_queue.empty() and time.time() < deadline:
+        time.sleep(0.05)
+
+    # Saves the update offset for the new process
+    save_state()
+
+    logger.info(f"Handing over to process {process.pid}")
+
+    # Exiting closes 'go_w' which lets the new process start polling
+    log_listener.stop()
+    os._exit(0)
+
+
+# Signal old process that we are ready and wait until it has exited
+def wait_for_handoff():
+    index = sys.argv.index("--handoff")
+    ready_fd, go_fd = int(sys.argv[index + 1]), int(sys.argv[index + 2])
+
+    os.write(ready_fd, b"1")
+    os.close(ready_fd)
+
+    # Returns EOF once the old process is gone
+    os.read(go_fd, 1)
+    os.close(go_fd)
+
+
+# Sample stacks of all threads for some seconds and send the result to the developer
+@restrict_access
+@run_slow(PROFILE_MAX_SEC + 30)
+def profile(bot, update, args):
+    try:
+        seconds = min(max(float(args[0]), 1), PROFILE_MAX_SEC) if args else 10
+    except ValueError:
+        msg = "Usage: /profile <seconds>"
+        update.message.reply_text(msg)
+        return
+
+    if not profile_lock.acquire(blocking=False):
+        msg = "Profiler is already running"
+        update.message.reply_text(msg)
+        return
+
+    try:
+        update.message.reply_text(f"Profiling all threads for {seconds:g} seconds...")
+        stacks, samples, overhead = sample_stacks(seconds)
+    finally:
+        profile_lock.release()
+
+    header = f"{seconds:g} s, {samples} samples, sampling overhead {overhead:.1%}"
+
+    # Collapsed stacks can be turned into a flame graph with 'flamegraph.pl'
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    document = io.BytesIO(collapsed.encode("utf-8"))
+    filename = time.strftime("profile-%Y%m%d-%H%M%S.txt")
+
+    bot.send_document(chat_id=config["dev_user_id"], document=document, filename=filename, caption=header)
+    bot.send_message(chat_id=config["dev_user_id"], text=profile_summary(stacks, header))
+
+    if update.message.chat_id != config["dev_user_id"]:
+        update.message.reply_text("Profile sent to developer")
+
+
+# Sample call stacks of all threads except the current one. Returns counts per
+# collapsed stack ("thread;file:function;...") plus number of samples and overhead
+def sample_stacks(seconds):
+    own_thread = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    sampling = 0.0
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        sample_start = time.perf_counter()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+
+            stack = list()
+            while frame:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+
+            stack.append(names.get(thread_id, str(thread_id)))
+            stack = ";".join(reversed(stack))
+
+            if stack in stacks or len(stacks) < PROFILE_MAX_STACKS:
+                stacks[stack] += 1
+            else:
+                stacks["other"] += 1
+
+        samples += 1
+        duration = time.perf_counter() - sample_start
+        sampling += duration
+
+        # With many threads a sample gets expensive. Then wait longer so that
+        # sampling never takes more than PROFILE_MAX_OVERHEAD of the time
+        time.sleep(max(PROFILE_INTERVAL, duration / PROFILE_MAX_OVERHEAD - duration))
+
+    return stacks, samples, sampling / (time.perf_counter() - start)
+
+
+# Functions that were seen most often on top of a stack (own) and anywhere in a stack (total)
+def profile_summary(stacks, header):
+    own = Counter()
+    total = Counter()
+
+    for stack, count in stacks.items():
+        frames = stack.split(";")[1:] or [stack]
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+
+    all_samples = sum(stacks.values()) or 1
+
+    lines = [f"Profile: {header}", "", "Own time:"]
+    lines += [f"{count / all_samples:6.1%}  {frame}" for frame, count in own.most_common(PROFILE_TOP)]
+    lines += ["", "Total time:"]
+    lines += [f"{count / all_samples:6.1%}  {frame}" for frame, count in total.most_common(PROFILE_TOP)]
+
+    # Telegram limit for message length
+    return "\n".join(lines)[:4096]
+
+
+# Let Telegram send updates to our webserver instead of polling for them
+def start_webhook():
+    updater.bot.set_webhook(url=config["webhook_url"],
+                            max_connections=config["webhook_max_conn"],
+                            secret_token=webhook_secret)
+
+    # Start everything that 'start_polling()' would start, except polling
+    updater.running = True
+    job_queue.start()
+    threading.Thread(target=dispatcher.start, name="dispatcher").start()
 
 
 # This needs to be run on a new thread because calling 'updater.stop()' inside a
 # handler (shutdown_cmd) causes a deadlock because it waits for itself to finish
 def shutdown():
+    slow_executor.shutdown(wait=False)
     updater.stop()
     updater.is_idle = False
 
+    save_state()
+    stop_workers()
+
+    if web_server:
+        web_server.shutdown()
+    if observer:
+        observer.stop()
+
 
 # Terminate this script
 @check_private_chat
 @restrict_access
 def shutdown_bot(bot, update):
     update.message.reply_text("Shutting down...")
+
+    # Process that receives updates stops the workers
+    if worker_index is not None:
+        os.kill(os.getppid(), signal.SIGTERM)
+        return
+
     # See comments on the 'shutdown' function
     threading.Thread(target=shutdown).start()
 
 
 # Ban the user you are replying to
 @restrict_access
-def ban(bot, update, auto_ban=False):
-    chat_id = update.message.chat_id
+def ban(bot, update):
+    # Message has to be a reply
+    if update.message.reply_to_message is None:
+        return
 
-    # For auto-banning bots
-    if auto_ban:
-        user_id = update.message.from_user.id
-    else:
-        # Message has to be a reply
-        if update.message.reply_to_message is None:
-            return
+    # Has to be in a group, not in private chat
+    if bot.get_chat(update.message.chat_id).type == Chat.PRIVATE:
+        return
 
-        # Has to be in a group, not in private chat
-        if bot.get_chat(update.message.chat_id).type == Chat.PRIVATE:
-            return
+    ban_user(bot, update.message.chat_id, update.message.reply_to_message.from_user)
 
-        user_id = update.message.reply_to_message.from_user.id
 
-    success = bot.kick_chat_member(chat_id=chat_id, user_id=user_id)
+# Ban given user from chat and let the chat know about it
+def ban_user(bot, chat_id, user):
+    success = bot.kick_chat_member(chat_id=chat_id, user_id=user.id)
 
     if success:
-        username = update.message.reply_to_message.from_user.username
-        first_name = update.message.reply_to_message.from_user.first_name
+        if user.username:
+            msg = "User @" + user.username + " banned"
+        else:
+            msg = user.first_name + " banned"
 
-        if username:
-            msg = "User @" + username + " banned"
+        bot.send_message(chat_id=chat_id, text=msg, disable_notification=True)
+
+
+# Mute given user for some minutes and let the chat know about it
+def mute_user(bot, chat_id, user, minutes):
+    # Unix time. A naive datetime would be taken as local time by the Telegram library
+    until = int(time.time()) + minutes * 60
+    success = bot.restrict_chat_member(chat_id, user.id, until_date=until, can_send_messages=False)
+
+    if success:
+        if user.username:
+            msg = "User @" + user.username + " muted for " + str(minutes) + " minutes"
         else:
-            msg = first_name + " banned"
+            msg = user.first_name + " muted for " + str(minutes) + " minutes"
 
         bot.send_message(chat_id=chat_id, text=msg, disable_notification=True)
 
@@ -947,6 +3508,91 @@ def delete(bot, update):
         bot.delete_message(chat_id=chat_id, message_id=original_msg.message_id)
 
 
+# Delete recent messages of the user you are replying to. Usage: '/purge [number | minutes + m] [ban]'
+# ('/purge 50', '/purge 10m ban'). Without number or minutes all indexed messages get deleted
+@restrict_access
+@run_slow(120)
+def purge(bot, update, args):
+    message = update.message
+    original_msg = message.reply_to_message
+
+    # Has to be a reply in a group
+    if original_msg is None or message.chat.type == Chat.PRIVATE:
+        return
+
+    count, since, ban_usr = None, None, False
+
+    for arg in args:
+        arg = arg.lower()
+
+        if arg == "ban":
+            ban_usr = True
+        elif arg.isdigit():
+            count = int(arg)
+        elif arg.endswith("m") and arg[:-1].isdigit():
+            since = time.time() - int(arg[:-1]) * 60
+        else:
+            msg = "Usage: /purge [number | minutes + m] [ban]"
+            message.reply_text(msg)
+            return
+
+    user = original_msg.from_user
+
+    # Stop user from posting more while his messages get deleted
+    if ban_usr:
+        ban_user(bot, message.chat_id, user)
+
+    message_ids = pop_recent_msgs(message.chat_id, user.id, count, since)
+
+    # Message might be older than the index. It still has to be within the given number or minutes
+    in_count = count is None or count > len(message_ids)
+    in_time = since is None or to_timestamp(original_msg.date) >= since
+    if original_msg.message_id not in message_ids and in_count and in_time:
+        message_ids.append(original_msg.message_id)
+
+    start = time.time()
+    deleted = delete_messages(bot, message.chat_id, message_ids)
+    delete_message(bot, message.chat_id, message.message_id)
+
+    name = "@" + user.username if user.username else user.first_name
+    msg = f"Deleted {deleted} of {len(message_ids)} messages of {name} in {time.time() - start:.1f} seconds"
+    bot.send_message(chat_id=message.chat_id, text=msg, disable_notification=True)
+
+
+# Delete messages in batches of at most 'purge_per_sec' messages per second. Returns number of deleted messages
+def delete_messages(bot, chat_id, message_ids):
+    batch_size = config["purge_per_sec"]
+    deleted = 0
+
+    with ThreadPoolExecutor(PURGE_THREADS, thread_name_prefix="purge") as pool:
+        for start in range(0, len(message_ids), batch_size):
+            batch_start = time.time()
+            batch = message_ids[start:start + batch_size]
+            deleted += sum(pool.map(lambda message_id: delete_message(bot, chat_id, message_id), batch))
+
+            # Wait for the rest of the second before next batch
+            wait = 1 - (time.time() - batch_start)
+            if wait > 0 and start + batch_size < len(message_ids):
+                time.sleep(wait)
+
+    return deleted
+
+
+# Delete one message. Waits and tries again once if Telegram asks to slow down
+def delete_message(bot, chat_id, message_id):
+    for _ in range(2):
+        try:
+            return bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except RetryAfter as ex:
+            time.sleep(ex.retry_after)
+        except TelegramError as ex:
+            # Already deleted or too old to be deleted by bots
+            logger.debug(f"Can't delete message {message_id} in chat {chat_id}: {ex}")
+            return False
+
+    return False
+
+
 # Cancel a poll-conversation with the bot
 def poll_cancel(bot, update):
     update.message.reply_text("Poll canceled", reply_markup=ReplyKeyboardRemove())
@@ -958,83 +3604,601 @@ def handle_telegram_error(bot, update, error):
     # Log error
     logger.error("Update '%s' caused error '%s'" % (update, error))
 
-    # Send message to user if source of error is a message
-    if update and update.message:
-        msg = "Oh, something went wrong \U00002639"
-        update.message.reply_text(msg)
+    now = time.time()
 
-    # Send error to admin
+    # Collect error for admin
     if config["send_error"]:
-        msg = type(error).__name__ + ": " + str(error)
-        bot.send_message(chat_id=config["dev_user_id"], text=msg)
+        record_error(bot, error, now)
+
+    # Send message to user if source of error is a message. Not
+    # more than once in a while per chat, errors often come in bulk
+    if update and update.message:
+        chat_id = update.message.chat_id
+
+        with error_lock:
+            reply = now - error_replies.get(chat_id, 0) >= config["error_reply_sec"]
+
+            if reply:
+                error_replies[chat_id] = now
+                error_replies.move_to_end(chat_id)
+
+                # Chats that got no reply for long enough don't need to be remembered
+                while error_replies and (len(error_replies) > ERROR_REPLY_CHATS or
+                                         now - next(iter(error_replies.values())) >= config["error_reply_sec"]):
+                    error_replies.popitem(last=False)
+
+        if reply:
+            try:
+                msg = "Oh, something went wrong \U00002639"
+                update.message.reply_text(msg)
+            except TelegramError as ex:
+                logger.warning(f"Can't send error reply: {ex}")
+
+
+# Identify error by its type and the function in this script where it happened. If it
+# didn't happen in this script, the innermost function of the traceback is used. Line
+# numbers are left out, otherwise every update of the script would report all errors again
+def error_fingerprint(error):
+    script = os.path.basename(__file__)
+    site = None
+
+    traceback = error.__traceback__
+    while traceback:
+        code = traceback.tb_frame.f_code
+        file = os.path.basename(code.co_filename)
+
+        if file == script or not site or not site.startswith(script):
+            site = f"{file}:{code.co_name}"
 
+        traceback = traceback.tb_next
 
-# Log all errors
-dispatcher.add_error_handler(handle_telegram_error)
+    return f"{type(error).__name__} in {site or 'unknown'}"
 
 
-# CommandHandlers to provide commands
-dispatcher.add_handler(CommandHandler("cmc", cmc))
-dispatcher.add_handler(CommandHandler("ban", ban))
-dispatcher.add_handler(CommandHandler("help", help))
-dispatcher.add_handler(CommandHandler("start", help))
-dispatcher.add_handler(CommandHandler("price", price))
-dispatcher.add_handler(CommandHandler("delete", delete))
-dispatcher.add_handler(CommandHandler("update", update_bot))
-dispatcher.add_handler(CommandHandler("admin", usr_to_admin))
-dispatcher.add_handler(CommandHandler("version", version_bot))
-dispatcher.add_handler(CommandHandler("restart", restart_bot))
-dispatcher.add_handler(CommandHandler("shutdown", shutdown_bot))
-dispatcher.add_handler(CommandHandler("wiki", wiki, pass_args=True))
-dispatcher.add_handler(CommandHandler("config", change_cfg, pass_args=True))
-dispatcher.add_handler(CommandHandler("feedback", feedback, pass_args=True))
+# Count error for next digest. Errors that were never seen before are sent at once
+def record_error(bot, error, now):
+    global error_known
 
+    fingerprint = error_fingerprint(error)
 
-# ConversationHandler for poll
+    with error_lock:
+        entry = error_digest.get(fingerprint)
+
+        if entry:
+            entry["count"] += 1
+            entry["last"] = now
+            entry["msg"] = str(error)
+        else:
+            error_digest[fingerprint] = {"count": 1, "first": now, "last": now, "msg": str(error)}
+
+        # Reported fingerprints survive a restart. After that they are only kept in memory
+        if error_known is None:
+            error_known = OrderedDict.fromkeys(get_state("error_fingerprints", list()))
+
+        new = fingerprint not in error_known
+
+        if new:
+            error_known[fingerprint] = None
+
+            while len(error_known) > ERROR_FINGERPRINTS:
+                error_known.popitem(last=False)
+
+            set_state("error_fingerprints", list(error_known))
+
+    if new:
+        try:
+            msg = f"New error: {fingerprint}\n{error}"
+            bot.send_message(chat_id=config["dev_user_id"], text=msg[:4096])
+        except TelegramError as ex:
+            logger.warning(f"Can't send error alert: {ex}")
+
+
+# Send all errors since last digest as one message to admin
+def send_error_digest(bot, job):
+    global error_digest
+
+    with error_lock:
+        digest, error_digest = error_digest, dict()
+
+    if not digest:
+        return
+
+    def clock(timestamp):
+        return time.strftime("%H:%M:%S", time.localtime(timestamp))
+
+    lines = [f"Errors of the last {format_age(job.interval)}:"]
+    for fingerprint, entry in sorted(digest.items(), key=lambda item: -item[1]["count"]):
+        lines.append(f"{entry['count']}x {fingerprint} ({clock(entry['first'])} - {clock(entry['last'])})\n"
+                     f"{entry['msg'][:200]}")
+
+    try:
+        bot.send_message(chat_id=config["dev_user_id"], text="\n\n".join(lines)[:4096])
+    except TelegramError as ex:
+        logger.warning(f"Can't send error digest: {ex}")
+
+        # Keep errors for next digest
+        with error_lock:
+            for fingerprint, entry in digest.items():
+                newer = error_digest.get(fingerprint)
+
+                if newer:
+                    newer["count"] += entry["count"]
+                    newer["first"] = entry["first"]
+                else:
+                    error_digest[fingerprint] = entry
+
+
+# Remember last processed update. After a restart, skip
+# pending updates that are too old or too many to replay
+def track_update(bot, update):
+    global last_update_id, replayed_updates
+
+    last_update_id = update.update_id
+
+    message = update.effective_message
+    if not message or to_timestamp(message.date) >= START_TIME:
+        return
+
+    replayed_updates += 1
+
+    if replayed_updates > config["replay_max_updates"]:
+        raise DispatcherHandlerStop()
+    if time.time() - to_timestamp(message.date) > config["replay_max_min"] * 60:
+        raise DispatcherHandlerStop()
+
+
+# Load price alerts from state database. Only the process that runs the jobs needs them
+def load_alerts():
+    rows = state_db.execute("SELECT id, user_id, pair, op, price, created FROM alerts").fetchall()
+
+    with alert_lock:
+        for alert_id, user_id, pair, op, threshold, created in rows:
+            alerts[alert_id] = {"user_id": user_id, "pair": pair, "op": op, "price": threshold, "created": created}
+            alert_users.setdefault(user_id, set()).add(alert_id)
+            alert_thresholds.setdefault((pair, op), list()).append((threshold, alert_id))
+
+        for thresholds in alert_thresholds.values():
+            thresholds.sort()
+
+
+# Save update offset, poll conversations and user data. With workers, the offset
+# is saved by the process that receives updates and the rest by the first worker
+def save_state(bot=None, job=None):
+    if last_update_id is not None and worker_index is None:
+        set_state("update_offset", last_update_id + 1)
+
+    # Poll conversations and user data only exist in private chats
+    if not is_main_worker():
+        return
+
+    conversations = list(poll_handler.conversations.items())
+    set_state("conversations", [[chat_id, user_id, conv_state] for (chat_id, user_id), conv_state in conversations])
+
+    user_data = list(dispatcher.user_data.items())
+    set_state("user_data", {str(user_id): data for user_id, data in user_data if data})
+
+
+# Restore poll conversations and user data from state database
+def load_state():
+    for chat_id, user_id, conv_state in get_state("conversations", list()):
+        poll_handler.conversations[(chat_id, user_id)] = conv_state
+
+    for user_id, data in get_state("user_data", dict()).items():
+        dispatcher.user_data[int(user_id)] = data
+
+    if is_main_worker():
+        load_alerts()
+
+
+# ConversationHandler for poll. Created only once so that
+# conversations that are in progress survive a reload
 poll_handler = ConversationHandler(
-    entry_points=[CommandHandler("poll", poll, pass_args=True)],
+    entry_points=[CommandHandler("poll", poll, pass_args=True, pass_user_data=True)],
     states={
-        SAVE_ANSWER: [MessageHandler(Filters.text, poll_save_answer)],
+        SAVE_ANSWER: [MessageHandler(Filters.text, poll_save_answer, pass_user_data=True)],
         CREATE_TOPIC: [MessageHandler(Filters.text, poll_create_topic, pass_user_data=True)],
         CREATE_ANSWERS: [MessageHandler(Filters.text, poll_create_answers, pass_user_data=True)],
         CREATE_END: [MessageHandler(Filters.text, poll_create_end, pass_user_data=True)],
-        DELETE_POLL: [RegexHandler("^(yes|no)$", poll_delete)]
+        DELETE_POLL: [RegexHandler("^(yes|no)$", poll_delete, pass_user_data=True)]
     },
     fallbacks=[CommandHandler('cancel', poll_cancel)],
     allow_reentry=True)
-dispatcher.add_handler(poll_handler)
 
 
-# MessageHandlers that filter on specific content
-dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, welcome))
-dispatcher.add_handler(MessageHandler(Filters.text, check_msg))
+# Register all handlers. Existing handlers get replaced at once so
+# that updates are never processed while handlers are missing
+def add_handlers():
+    handlers = {-2: [
+        # Runs before all other handlers
+        TypeHandler(Update, track_update)
+    ], -1: [
+        # Every message in groups counts for flood protection, commands too
+        MessageHandler(Filters.group & (Filters.text | Filters.command | Filters.photo | Filters.video |
+                                        Filters.document | Filters.sticker | Filters.audio | Filters.voice),
+                       stop_flood)
+    ], 0: [
+        # CommandHandlers to provide commands
+        CommandHandler("cmc", cmc),
+        CommandHandler("ban", ban),
+        CommandHandler("help", help),
+        CommandHandler("start", help),
+        CommandHandler("price", price),
+        CommandHandler("delete", delete),
+        CommandHandler("alert", alert, pass_args=True),
+        CommandHandler("purge", purge, pass_args=True),
+        CommandHandler("update", update_bot),
+        CommandHandler("admin", usr_to_admin),
+        CommandHandler("version", version_bot),
+        CommandHandler("restart", restart_bot),
+        CommandHandler("profile", profile, pass_args=True),
+        CommandHandler("shutdown", shutdown_bot),
+        CommandHandler("wiki", wiki, pass_args=True),
+        CommandHandler("config", change_cfg, pass_args=True),
+        CommandHandler("feedback", feedback, pass_args=True),
+
+        # ConversationHandler for poll
+        poll_handler,
+
+        # Answers '@StelliteBot <query>' in any chat
+        InlineQueryHandler(inline_query),
+
+        # MessageHandlers that filter on specific content
+        MessageHandler(Filters.status_update.new_chat_members, welcome),
+        MessageHandler(Filters.status_update.pinned_message, pinned),
+        MessageHandler(Filters.text, check_msg)
+    ], 1: [
+        # Runs after all other handlers
+        MessageHandler(Filters.group, track_message)
+    ]}
+
+    # Process that receives updates already tracked them and skipped old ones
+    if worker_index is not None:
+        del handlers[-2]
+
+    # Only pass updates on to the workers
+    if worker_queues:
+        handlers = {-2: handlers[-2], 0: [TypeHandler(Update, route_update)]}
+
+    for group in handlers.values():
+        time_handlers(group)
+
+    dispatcher.handlers = handlers
+    dispatcher.groups = sorted(handlers)
+
+    # Log all errors
+    dispatcher.error_handlers = [handle_telegram_error]
+
+
+# Schedule repeating job and add it to 'scheduled'. A job that already exists is kept, so its
+# next run stays where it is. If its interval changed in config, only later runs use the new one
+def schedule_job(scheduled, name, callback, interval, first, context=None):
+    if name in jobs and not jobs[name][0].removed:
+        job, old_interval = jobs[name]
+
+        if interval != old_interval:
+            job.interval = interval
+
+        job.context = context
+    else:
+        job = job_queue.run_repeating(callback, interval, first=first, context=context, name=name)
+
+    scheduled[name] = (job, interval)
+
+
+# Schedule all repeating jobs. Jobs that are still in config keep running, others get removed
+def add_jobs():
+    scheduled = dict()
 
+    # Persist state that has to survive a restart
+    schedule_job(scheduled, "save_state", save_state, config["state_save_sec"], config["state_save_sec"])
 
-# Start the bot
-updater.start_polling(clean=True)
+    # Send collected errors to admin
+    if config["send_error"]:
+        schedule_job(scheduled, "error_digest", send_error_digest,
+                     config["error_digest_sec"], config["error_digest_sec"])
 
+    # Restart workers that died
+    if worker_queues:
+        schedule_job(scheduled, "check_workers", check_workers, WORKER_CHECK_SEC, WORKER_CHECK_SEC)
 
-# Check for new Tweets
-if config["twitter_account"]:
-    job_queue.run_repeating(check_twitter, config["check_tweet"], first=0)
+    # Jobs below run only once for all workers
+    if is_main_worker():
+        add_main_jobs(scheduled)
 
+    for name, (job, _) in jobs.items():
+        if name not in scheduled:
+            job.schedule_removal()
 
-# Repost messages at given time
-for repost in config["reposts"]:
-    if repost["text"]:
-        interval = repost["repeat_min"] * 60
-        start = repost["start_min"] * 60
-        job_queue.run_repeating(repost_msg, interval, first=start, context=repost)
+    jobs.clear()
+    jobs.update(scheduled)
 
 
-# Send message that bot is started after restart
-if config["restart_usr"]:
-    msg = "Bot started..."
-    updater.bot.send_message(chat_id=config["restart_usr"], text=msg)
+# Schedule jobs that only the process that handles private chats runs
+def add_main_jobs(scheduled):
+    # Check price alerts on new TradeOgre prices
+    schedule_job(scheduled, "check_alerts", check_alerts, config["alert_check_sec"], config["alert_check_sec"])
 
-    # Set key to empty value
-    update_cfg("restart_usr", None)
+    # Keep CoinMarketCap data up to date. First run right away only applies at startup
+    schedule_job(scheduled, "refresh_cmc", refresh_cmc, config["cmc_refresh_sec"], 0)
+
+    # Check all feeds for new items
+    init_feeds()
+    if feeds:
+        schedule_job(scheduled, "check_feeds", check_feeds, config["feed_tick_sec"], 0)
+
+    # Repost messages at given time. Global reposts go to main chat
+    chat_reposts = [(config["chat_id"], config["reposts"])]
+    chat_reposts += [(chat_key, overlay.get("reposts", list())) for chat_key, overlay in config["chats"].items()]
+
+    for chat_id, reposts in chat_reposts:
+        for number, repost in enumerate(reposts):
+            if repost["text"]:
+                interval = repost["repeat_min"] * 60
+                start = repost["start_min"] * 60
+                context = dict(repost, chat_id=chat_id)
+                schedule_job(scheduled, f"repost:{chat_id}:{number}", repost_msg, interval, start, context)
+
+
+# Reload config, handlers and jobs without restarting the process.
+# Returns the time in seconds that the reload took
+def reload_bot():
+    start = time.time()
+
+    read_cfg()
+    set_log_levels()
+    reload_webhook_secret()
+    init_price_sources()
+    add_handlers()
+    add_jobs()
+
+    return time.time() - start
+
+
+# Start receiving updates from Telegram
+def start_bot():
+    if config["webhook_url"]:
+        start_webhook()
+    else:
+        # Continue with first update that wasn't processed before restart
+        offset = get_state("update_offset")
+
+        if offset:
+            updater.last_update_id = offset
+            updater.start_polling()
+        else:
+            updater.start_polling(clean=True)
+
+
+# True if this process handles private chats and runs the jobs. That's the only process or the
+# first worker. Private chats and commands that change the config go there, so only it writes the config
+def is_main_worker():
+    return not worker_queues and not worker_index
+
+
+# Pass update on to the worker of its chat. Updates of one chat always go to the same worker
+# so that they are handled in order. All private chats, updates without chat and commands that
+# change the config go to the first
+def route_update(bot, update):
+    chat = update.effective_chat
+
+    if chat is None or chat.type == Chat.PRIVATE or is_cfg_command(update.effective_message):
+        index = 0
+    else:
+        index = chat.id % len(worker_queues)
+
+    # Blocks if the worker can't keep up. Updates then queue up in this process
+    worker_queues[index].put(update.to_json())
+
+
+# Check if message is a command that changes the config file (see 'CFG_COMMANDS')
+def is_cfg_command(message):
+    if not message or not message.text or not message.text.startswith("/"):
+        return False
+
+    # '/config@StelliteBot' in groups
+    return message.text.split()[0][1:].split("@")[0].lower() in CFG_COMMANDS
+
+
+# Start processes that handle updates. Every worker has its own queue
+def start_workers():
+    global worker_control
+
+    worker_control = worker_context.Queue()
+
+    for index in range(config["workers"]):
+        worker_queues.append(worker_context.Queue(config["worker_max_queue"]))
+        worker_procs.append(None)
+        start_worker(index)
+
+    threading.Thread(target=relay_reloads, name="worker-reloads", daemon=True).start()
+
+
+# Reload this process and all workers except the one that asked for it (see 'restart_bot')
+def relay_reloads():
+    while True:
+        sender = worker_control.get()
+        reload_bot()
+
+        for index, updates in enumerate(worker_queues):
+            if index != sender:
+                updates.put(WORKER_RELOAD)
+
+
+# Start (or restart) worker with given index. Queued updates are kept on restart
+def start_worker(index):
+    process = worker_context.Process(target=run_worker,
+                                     args=(index, worker_queues[index], worker_control),
+                                     name=f"worker-{index}",
+                                     daemon=True)
+    process.start()
+    worker_procs[index] = process
+
+
+# Restart workers that exited unexpectedly
+def check_workers(bot, job):
+    for index, process in enumerate(worker_procs):
+        if not process.is_alive():
+            logger.error(f"Worker {index} exited with code {process.exitcode}. Restarting it")
+            start_worker(index)
+
+
+# Let workers handle all queued updates and wait until they exited
+def stop_workers():
+    processes = list(worker_procs)
+    worker_procs.clear()
+
+    for updates in worker_queues[:len(processes)]:
+        updates.put(None)
+
+    for index, process in enumerate(processes):
+        # Worker needs up to 'worker_stop_sec' for queued updates and then some time to stop
+        process.join(config["worker_stop_sec"] * 2)
+
+        if process.is_alive():
+            logger.warning(f"Worker {index} didn't stop in time. Terminating it")
+            process.terminate()
+
+
+# Main function of worker process. Handles updates from its queue until it gets 'None'.
+# Reloads if it gets 'WORKER_RELOAD'
+def run_worker(index, updates, control):
+    global worker_index, worker_control
+
+    worker_index = index
+    worker_control = control
+
+    # Ctrl+C reaches all processes. The process that receives updates stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    run_phase("config", read_cfg)
+    run_phase("logging", init_logging)
+    run_phase("executor", init_executor)
+    run_phase("prices", init_price_sources)
+    run_phase("bot", init_bot)
+    run_phase("state", init_state)
+    run_phase("handlers", add_handlers)
+    run_phase("restore", load_state)
+    run_phase("watchdog", init_watchdog)
+
+    # Start everything that 'start_polling()' would start, except polling
+    updater.running = True
+    job_queue.start()
+    threading.Thread(target=dispatcher.start, name="dispatcher").start()
+
+    run_phase("jobs", add_jobs)
+
+    logger.info(f"Worker {index} started in {sum(startup_times.values()):.2f} seconds")
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+
+        # Another worker got '/restart'
+        if data == WORKER_RELOAD:
+            reload_bot()
+            continue
+
+        dispatcher.update_queue.put(Update.de_json(json.loads(data), updater.bot))
+
+    # Let the dispatcher work off what it already got
+    deadline = time.time() + config["worker_stop_sec"]
+    while not dispatcher.update_queue.empty() and time.time() < deadline:
+        time.sleep(0.05)
+
+    shutdown()
+
+
+# Run startup phase and remember how long it took
+def run_phase(name, func):
+    start = time.time()
+    func()
+    startup_times[name] = time.time() - start
+
+
+# Print duration of all startup phases and of the modules that are loaded on first use
+def profile_startup():
+    lines = ["Startup profile:"]
+
+    for name, duration in startup_times.items():
+        lines.append("{0:<12} {1:>8.1f} ms".format(name, duration * 1000))
+
+    total = sum(startup_times.values())
+    lines.append("{0:<12} {1:>8.1f} ms".format("total", total * 1000))
+
+    lines.append("Loaded on first use (not part of startup):")
+
+    for module, load in [("matplotlib.pyplot", get_pyplot),
+                         ("twitter", lambda: __import__("twitter")),
+                         ("coinmarketcap", lambda: __import__("coinmarketcap"))]:
+        start = time.time()
+        load()
+        lines.append("{0:<18} {1:>8.1f} ms".format(module, (time.time() - start) * 1000))
+
+    print("\n".join(lines))
+
+
+def main():
+    startup_times["imports"] = time.time() - START_TIME
+
+    run_phase("config", read_cfg)
+    run_phase("logging", init_logging)
+    run_phase("executor", init_executor)
+    run_phase("prices", init_price_sources)
+    run_phase("bot", init_bot)
+    run_phase("state", init_state)
+
+    # Profiling only measures the startup. It doesn't start workers and doesn't
+    # take updates away from the bot that is running (or post anything)
+    profiling = "--profile-startup" in sys.argv
+
+    # Before workers start, so that only this process writes the config
+    if not profiling:
+        migrate_poll()
+
+    # Updates get handled by worker processes. This one only receives them
+    if config["workers"] and not profiling:
+        run_phase("workers", start_workers)
+
+    run_phase("handlers", add_handlers)
+
+    # Everything above is warmed up while the old process keeps serving
+    if "--handoff" in sys.argv:
+        run_phase("handoff", wait_for_handoff)
+
+    if not profiling:
+        run_phase("webserver", init_web)
+
+    run_phase("restore", load_state)
+    run_phase("watchdog", init_watchdog)
+
+    if not profiling:
+        run_phase("start", start_bot)
+
+    # Without 'start' the job queue doesn't run, jobs only get scheduled
+    run_phase("jobs", add_jobs)
+
+    # State isn't saved, it belongs to the bot that is running
+    if profiling:
+        profile_startup()
+        observer.stop()
+        return
+
+    # Send message that bot is started after restart
+    if config["restart_usr"]:
+        msg = "Bot started..."
+        updater.bot.send_message(chat_id=config["restart_usr"], text=msg)
+
+        # Set key to empty value
+        update_cfg("restart_usr", None)
+
+    # Change to idle mode
+    updater.idle()
+
+    # Stopped by signal - state isn't saved yet and workers are still running
+    save_state()
+    stop_workers()
 
 
-# Change to idle mode
-updater.idle()
+if __name__ == "__main__":
+    main()